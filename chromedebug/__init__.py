@@ -1,10 +1,29 @@
 import os
 import sys
 
-__all__ = ['console', 'profiler']
+__all__ = ['console', 'profiler', 'timeline']
+
+OPTIONS = {
+    '--profile': 'CHROMEDEBUG_PROFILE',
+    '--format': 'CHROMEDEBUG_PROFILE_FORMAT'}
+
+
+def _parse_options(args):
+    # only leading options are ours, everything else goes to the interpreter
+    while args and args[0].split('=', 1)[0] in OPTIONS:
+        option = args.pop(0)
+        if '=' in option:
+            name, value = option.split('=', 1)
+        elif args:
+            name, value = option, args.pop(0)
+        else:
+            sys.exit('%s requires a value' % (option,))
+        os.environ[OPTIONS[name]] = value
+    return args
 
 
 def main():
+    args = _parse_options(sys.argv[1:])
     cur_path = os.path.dirname(__file__)
     boot_path = os.path.join(cur_path, 'boot')
     if 'PYTHONPATH' in os.environ:
@@ -12,4 +31,4 @@ def main():
             boot_path, os.environ['PYTHONPATH'])
     else:
         os.environ['PYTHONPATH'] = boot_path
-    os.execl(sys.executable, sys.executable, *sys.argv[1:])
+    os.execl(sys.executable, sys.executable, *args)
@@ -1,4 +1,5 @@
 import os
+import signal
 import sys
 
 cur_path = os.path.dirname(__file__)
@@ -6,8 +7,79 @@ parent_path = os.path.abspath(os.path.join(cur_path, '..', '..'))
 if not parent_path in sys.path:
     sys.path.append(parent_path)
 
-from chromedebug import debugger
-from chromedebug import thread
+FALSE_VALUES = ['0', 'false', 'no', 'off']
+# ignored by default so an application is unlikely to rely on it
+DEFAULT_TRACE_SIGNAL = 'SIGURG'
 
-#debugger.attach()
-thread.start()
+
+def get_flag(name, default=True):
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.lower() not in FALSE_VALUES
+
+
+def get_signal(name, default=None):
+    value = os.environ.get(name) or default
+    if not value or value.lower() in FALSE_VALUES:
+        return None
+    if value.isdigit():
+        return int(value)
+    if not value.startswith('SIG'):
+        value = 'SIG' + value
+    return getattr(signal, value, None)
+
+
+def export_profile(path, fmt):
+    from chromedebug import export
+    from chromedebug import profiler
+    header = profiler.stop_profiling()
+    export.export_profile(header['uid'], path, fmt)
+    sys.stderr.write('Profile written to %s\n' % (path,))
+
+
+def remove_boot_path():
+    boot_path = os.path.abspath(cur_path)
+    paths = os.environ.get('PYTHONPATH', '').split(os.pathsep)
+    paths = [path for path in paths
+             if path and os.path.abspath(path) != boot_path]
+    if paths:
+        os.environ['PYTHONPATH'] = os.pathsep.join(paths)
+    else:
+        os.environ.pop('PYTHONPATH', None)
+
+
+def boot():
+    # keep this cheap, everything we start here runs before the user's code
+    if not get_flag('CHROMEDEBUG_INHERIT'):
+        remove_boot_path()
+    if not get_flag('CHROMEDEBUG_ENABLE'):
+        return
+    from chromedebug import thread
+    profile_path = os.environ.pop('CHROMEDEBUG_PROFILE', None)
+    profile_format = os.environ.pop('CHROMEDEBUG_PROFILE_FORMAT', None)
+    # the main thread can only be traced once it handles this signal
+    trace_signal = get_signal('CHROMEDEBUG_TRACE_SIGNAL',
+                              DEFAULT_TRACE_SIGNAL)
+    if trace_signal:
+        thread.install_trace_signal(trace_signal)
+    toggle_signal = get_signal('CHROMEDEBUG_SIGNAL')
+    if toggle_signal:
+        thread.install_signal(toggle_signal)
+    if os.environ.get('CHROMEDEBUG_METRICS'):
+        from chromedebug import metrics
+        metrics.enable()
+    thread.set_socket_dir(os.environ.get('CHROMEDEBUG_SOCKET_DIR'))
+    thread.set_address(os.environ.get('CHROMEDEBUG_HOST', ''),
+                       int(os.environ.get('CHROMEDEBUG_PORT', 9222)))
+    thread.install_fork_hook()
+    if profile_path:
+        import atexit
+        from chromedebug import profiler
+        atexit.register(export_profile, profile_path, profile_format)
+        profiler.start_profiling()
+    else:
+        thread.start()
+
+
+boot()
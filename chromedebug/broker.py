@@ -0,0 +1,141 @@
+import errno
+import json
+import optparse
+import os
+import sys
+from wsgiref.simple_server import make_server
+
+from ws4py.client.threadedclient import WebSocketClient
+from ws4py.server.wsgirefserver import WSGIServer, WebSocketWSGIRequestHandler
+from ws4py.server.wsgiutils import WebSocketWSGIApplication
+from ws4py.websocket import WebSocket
+
+from .thread import get_socket_path, remove_socket
+
+__all__ = ['main']
+
+DEFAULT_SOCKET_DIR = '/tmp/chromedebug'
+
+
+class WorkerConnection(WebSocketClient):
+
+    def __init__(self, path, peer):
+        super(WorkerConnection, self).__init__('ws+unix://%s' % (path,))
+        self.peer = peer
+
+    def received_message(self, message):
+        self.peer.send(message.data)
+
+    def closed(self, code, reason=None):
+        self.peer.close()
+
+
+class BrokerWebSocket(WebSocket):
+    socket_dir = None
+    worker = None
+
+    def opened(self):
+        pid = self.environ.get('PATH_INFO', '').strip('/')
+        if not pid in get_workers(self.socket_dir):
+            self.close(1011, reason='No such worker')
+            return
+        self.worker = WorkerConnection(
+            get_socket_path(self.socket_dir, int(pid)), peer=self)
+        try:
+            self.worker.connect()
+        except Exception:
+            self.worker = None
+            self.close(1011, reason='Worker is not responding')
+
+    def received_message(self, message):
+        if self.worker:
+            self.worker.send(message.data)
+
+    def closed(self, code, reason=None):
+        if self.worker:
+            self.worker.close()
+
+
+class BrokerApplication(object):
+
+    def __init__(self, socket_dir):
+        self.socket_dir = socket_dir
+        handler = type('BrokerWebSocket', (BrokerWebSocket,), {
+            'socket_dir': socket_dir})
+        self.websocket_app = WebSocketWSGIApplication(handler_cls=handler)
+
+    def __call__(self, environ, start_response):
+        if environ.get('PATH_INFO') in ['/json', '/json/list']:
+            host = environ.get('HTTP_HOST', 'localhost:9222')
+            targets = get_targets(self.socket_dir, host)
+            start_response('200 OK', [('Content-Type', 'application/json')])
+            return [json.dumps(targets)]
+        return self.websocket_app(environ, start_response)
+
+
+def get_workers(socket_dir):
+    workers = []
+    try:
+        names = os.listdir(socket_dir)
+    except OSError:
+        return workers
+    for name in sorted(names):
+        pid, ext = os.path.splitext(name)
+        if ext != '.sock' or not pid.isdigit():
+            continue
+        try:
+            os.kill(int(pid), 0)
+        except OSError, e:
+            if e.errno == errno.ESRCH:
+                remove_socket(os.path.join(socket_dir, name))
+                continue
+        workers.append(pid)
+    return workers
+
+
+def get_targets(socket_dir, host):
+    targets = []
+    for pid in get_workers(socket_dir):
+        url = '%s/%s' % (host, pid)
+        targets.append({
+            'id': pid,
+            'type': 'other',
+            'title': 'Python process %s' % (pid,),
+            'url': 'pid://%s' % (pid,),
+            'webSocketDebuggerUrl': 'ws://%s' % (url,),
+            'devtoolsFrontendUrl': (
+                'chrome://devtools/devtools.html?ws=%s' % (url,))})
+    return targets
+
+
+def main(args=None):
+    parser = optparse.OptionParser(
+        usage='%prog [options]',
+        description='Expose the debuggers of all processes that listen in '
+                    'SOCKET_DIR through a single port.')
+    parser.add_option('--host', default='')
+    parser.add_option('--port', type='int', default=9222)
+    parser.add_option(
+        '--socket-dir',
+        default=os.environ.get('CHROMEDEBUG_SOCKET_DIR', DEFAULT_SOCKET_DIR))
+    options, args = parser.parse_args(args)
+    if not os.path.isdir(options.socket_dir):
+        os.makedirs(options.socket_dir)
+    server = make_server(
+        options.host, options.port, server_class=WSGIServer,
+        handler_class=WebSocketWSGIRequestHandler,
+        app=BrokerApplication(options.socket_dir))
+    sys.stderr.write(
+        'Listing processes at http://%s:%d/json\n' % (
+            options.host or 'localhost', options.port))
+    server.initialize_websockets_manager()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,9 @@
 import atexit
-from collections import defaultdict, namedtuple
+from collections import defaultdict, namedtuple, OrderedDict
 import fnmatch
 from functools import wraps
 import inspect
+import os
 import sys
 import threading
 
@@ -13,6 +14,8 @@ seen = set()
 
 CallInfo = namedtuple('CallInfo', ['function', 'module', 'lineno'])
 debug_lock = threading.Lock()
+MAX_CODE_CACHE = 256
+code_cache = OrderedDict()
 
 
 def get_call_info(frame):
@@ -36,26 +39,58 @@ def get_call_info(frame):
     return CallInfo(function, module, info.lineno)
 
 
-class Debugger(object):
+class ThreadState(object):
 
-    breakpoints_active = True
-    profilers = None
     current_frame = None
     step_mode = None
     step_level = 0
     stop_module = None
     stop_lineno = None
 
+    def __init__(self, ident, name):
+        self.ident = ident
+        self.name = name
+        self.frames = {}
+        self.resume = threading.Event()
+
+
+class Debugger(object):
+
+    breakpoints_active = True
+    profilers = None
+    profile_hook = None
+    active_thread = None
+    tracing = False
+    trace_signal = None
+    main_thread = None
+    pause_all = False
+    pause_tracing = False
+    source_frame = None
+
     def __init__(self, skip=None):
         self.profilers = set()
-        self.resume = threading.Event()
+        self.clients = set()
+        self.threads = {}
+        self.paused = []
+        self.pause_threads = set()
+        self.traced_threads = set()
+        self.local = threading.local()
         self.skip = set(skip) if skip else None
         self.breaks = defaultdict(set)
         self.fncache = {}
 
     def trace_dispatch(self, frame, event, arg):
+        if not self.tracing:
+            sys.settrace(None)
+            if threading:
+                self.traced_threads.discard(threading.current_thread().ident)
+            return
         if self.skip and self.is_skipped(frame):
             return
+        if (self.profile_hook is not None and
+                sys.getprofile() is not self.profile_hook):
+            # threads that were running before the profiler started
+            sys.setprofile(self.profile_hook)
         if event == 'line':
             return self.dispatch_line(frame)
         if event == 'call':
@@ -64,39 +99,92 @@ class Debugger(object):
             return self.dispatch_return(frame, arg)
 
     def dispatch_line(self, frame):
-        if not self.step_mode:
-            if not self.breakpoints_active:
-                return
-        call_info = get_call_info(frame)
-        if not self.step_mode:
-            if not call_info.module in self.breaks:
-                return
-        if self.stop_here(call_info) or self.break_here(call_info):
-            self.pause(frame)
+        for profiler in self.profilers:
+            profiler.trace_line(frame)
+        state = self.get_thread_state()
+        if state.step_mode or self.is_pause_requested(state):
+            call_info = get_call_info(frame)
+        elif self.breakpoints_active and (self.breaks or state.stop_module):
+            call_info = get_call_info(frame)
+            if (not call_info.module in self.breaks and
+                    call_info.module != state.stop_module):
+                return self.get_local_trace()
+        else:
+            return self.get_local_trace()
+        if self.stop_here(state, call_info) or self.break_here(call_info):
+            self.pause(state, frame)
         return self.trace_dispatch
 
     def dispatch_call(self, frame, arg):
-        call_info = get_call_info(frame)
-        if not self.profilers:
-            if not self.step_mode:
-                if not self.breakpoints_active:
-                    return
-                call_info = get_call_info(frame)
-                if call_info.module in self.breaks:
-                    return
-        if self.step_mode in ['over', 'out']:
-            self.step_level += 1
+        state = self.get_thread_state()
+        if state.step_mode in ['over', 'out']:
+            state.step_level += 1
         for profiler in self.profilers:
-            profiler.trace_call(call_info)
+            if profiler.wants_lines(frame):
+                return self.trace_dispatch
+        if state.step_mode or self.is_pause_requested(state):
+            return self.trace_dispatch
+        if not self.breakpoints_active:
+            return
+        if not self.breaks and not state.stop_module:
+            return
         return self.trace_dispatch
 
     def dispatch_return(self, frame, arg):
-        if self.step_mode in ['over', 'out']:
-            self.step_level -= 1
-        if self.step_mode == 'out' and self.step_level < 0:
-            self.pause(frame)
-        for profiler in self.profilers:
-            profiler.trace_return()
+        state = self.get_thread_state()
+        if state.step_mode in ['over', 'out']:
+            state.step_level -= 1
+        if state.step_mode == 'out' and state.step_level < 0:
+            self.pause(state, frame)
+
+    def get_local_trace(self):
+        if self.profilers:
+            return self.trace_dispatch
+
+    def get_thread_state(self):
+        try:
+            return self.local.state
+        except AttributeError:
+            current = threading.current_thread()
+            state = ThreadState(current.ident, current.name)
+            self.local.state = state
+            with debug_lock:
+                self.threads[state.ident] = state
+            return state
+
+    def get_paused_state(self, ident=None):
+        if ident is None:
+            ident = self.active_thread
+        state = self.threads.get(ident)
+        if state and state.current_frame:
+            return state
+
+    def get_threads(self):
+        threads = []
+        with debug_lock:
+            alive = set()
+            for t in threading.enumerate():
+                alive.add(t.ident)
+                if t.name == 'ChromeDebug':
+                    continue
+                state = self.threads.get(t.ident)
+                threads.append({
+                    'threadId': t.ident,
+                    'name': t.name,
+                    'paused': bool(state and state.current_frame),
+                    'active': t.ident == self.active_thread})
+            for ident in list(self.threads):
+                if not ident in alive:
+                    del self.threads[ident]
+        return threads
+
+    def set_active_thread(self, ident):
+        state = self.get_paused_state(ident)
+        if not state:
+            return False
+        self.active_thread = ident
+        thread.debugger_paused(self.get_pause_info(state))
+        return True
 
     def is_skipped(self, frame):
         if not fnmatch:
@@ -111,15 +199,20 @@ class Debugger(object):
             frame = frame.f_back
         return False
 
-    def stop_here(self, call_info):
-        if self.step_mode == 'into':
+    def is_pause_requested(self, state):
+        return self.pause_all or state.ident in self.pause_threads
+
+    def stop_here(self, state, call_info):
+        if self.is_pause_requested(state):
+            return True
+        if state.step_mode == 'into':
             return True
-        if self.step_mode == 'over' and self.step_level <= 0:
+        if state.step_mode == 'over' and state.step_level <= 0:
             return True
-        if self.step_mode == 'out' and self.step_level < 0:
+        if state.step_mode == 'out' and state.step_level < 0:
             return True
-        if call_info.module == self.stop_module:
-            if call_info.lineno >= self.stop_lineno:
+        if call_info.module == state.stop_module:
+            if call_info.lineno >= state.stop_lineno:
                 return True
         return False
 
@@ -139,16 +232,23 @@ class Debugger(object):
         module = mod.__name__
         return module in self.breaks
 
-    def _extract_frames(self, frame):
+    def _extract_frames(self, frame, scopes=None):
+        if scopes is None:
+            scopes = {}
         info = get_call_info(frame)
         location = {
             'scriptId': info.module,
             'lineNumber': info.lineno - 1}
+        # frames of the same module share their global scope
+        global_scope = scopes.get(id(frame.f_globals))
+        if global_scope is None:
+            global_scope = scopes[id(frame.f_globals)] = {
+                'type': 'global',
+                'object': inspector.encode(frame.f_globals, preview=False)}
         scope_chain = [
             {'type': 'local',
              'object': inspector.encode(frame.f_locals, preview=False)},
-            {'type': 'global',
-             'object': inspector.encode(frame.f_globals, preview=False)}]
+            global_scope]
         frame_id = str(id(frame))
         frames = [{
             'callFrameId': frame_id,
@@ -156,77 +256,163 @@ class Debugger(object):
             'location': location,
             'scopeChain': scope_chain}]
         if frame.f_back and frame.f_back is not self.source_frame:
-            frames += self._extract_frames(frame.f_back)
+            frames += self._extract_frames(frame.f_back, scopes)
         return frames
 
-    def evaluate_on_frame(self, frame_id, expression):
-        frame = self.current_frame
-        while frame and str(id(frame)) != frame_id:
-            frame = frame.f_back
-        if not frame:
-            return None
-        try:
-            return eval(expression, frame.f_globals, frame.f_locals)
-        except:
-            exec(expression, frame.f_globals, frame.f_locals)
+    def get_paused_frame(self, frame_id):
+        for ident in list(self.paused):
+            state = self.threads.get(ident)
+            frame = state and state.frames.get(frame_id)
+            if frame:
+                return frame
 
-    def get_pause_info(self):
-        if not self.current_frame:
+    def get_pause_info(self, state=None):
+        state = state or self.get_paused_state()
+        if not state:
             return
-        frames = self._extract_frames(self.current_frame)
-        return {'callFrames': frames, 'reason': 'other'}
-
-    def pause(self, frame):
+        frames = self._extract_frames(state.current_frame)
+        data = {
+            'threadId': state.ident,
+            'threadName': state.name,
+            'pausedThreads': list(self.paused)}
+        return {'callFrames': frames, 'reason': 'other', 'data': data}
+
+    def pause(self, state, frame):
         if not thread or not threading:  # terminating
             return
         if threading.current_thread().name == 'ChromeDebug':
             return
         if not self.breakpoints_active:
             return
+        if state.current_frame:
+            return
+        frames = {}
+        current = frame
+        while current:
+            frames[str(id(current))] = current
+            current = current.f_back
         with debug_lock:
-            if self.current_frame:
-                return
-            self.current_frame = frame
-        self.resume.clear()
-        info = self.get_pause_info()
-        thread.debugger_paused(info)
-        self.resume.wait()
+            state.current_frame = frame
+            state.frames = frames
+            if self.pause_all:
+                self.pause_all = False
+            self.pause_threads.discard(state.ident)
+            self.paused.append(state.ident)
+            if self.active_thread is None:
+                self.active_thread = state.ident
+            announce = self.active_thread == state.ident
+        state.resume.clear()
+        if announce:
+            thread.debugger_paused(self.get_pause_info(state))
+        state.resume.wait()
         with debug_lock:
-            self.current_frame = None
-
-    def set_continue(self):
-        self.step_mode = None
-        self.stop_module = None
-        self.stop_lineno = None
+            state.current_frame = None
+            state.frames = {}
+            self.paused.remove(state.ident)
+            promoted = None
+            # a stepping thread stays active to show where it stops next
+            if self.active_thread == state.ident and not (
+                    state.step_mode or state.stop_module):
+                self.active_thread = None
+                if self.paused:
+                    self.active_thread = promoted = self.paused[0]
+        if promoted:
+            self.set_active_thread(promoted)
+
+    def resume_thread(self, state):
         thread.debugger_resumed()
-        self.resume.set()
+        state.resume.set()
 
-    def continue_to(self, module, lineno):
-        self.step_mode = None
-        self.stop_module = module
-        self.stop_lineno = lineno
-        thread.debugger_resumed()
-        self.resume.set()
+    def set_continue(self, ident=None):
+        state = self.get_paused_state(ident)
+        if not state:
+            return
+        state.step_mode = None
+        state.stop_module = None
+        state.stop_lineno = None
+        if len(self.paused) <= 1:
+            self.end_pause_tracing()
+        self.resume_thread(state)
+
+    def continue_to(self, module, lineno, ident=None):
+        state = self.get_paused_state(ident)
+        if not state:
+            return
+        state.step_mode = None
+        state.stop_module = module
+        state.stop_lineno = lineno
+        self.resume_thread(state)
+
+    def set_pause(self, thread_ids=None):
+        reachable = self.inject_trace(thread_ids)
+        if thread_ids:
+            unreachable = [ident for ident in thread_ids
+                           if not ident in reachable]
+        else:
+            unreachable = [ident for ident in sys._current_frames()
+                           if not ident in reachable and
+                           ident != threading.current_thread().ident]
+        if not reachable:
+            raise RuntimeError(
+                'None of the threads runs with a trace function, start '
+                'them while a client is connected or set '
+                'CHROMEDEBUG_TRACE_SIGNAL for the main thread')
+        if thread_ids:
+            self.pause_threads.update(reachable)
+        else:
+            self.pause_all = True
+        if not self.tracing:
+            self.pause_tracing = True
+            self.tracing = True
+        self.signal_main_thread(reachable)
+        return unreachable
+
+    def end_pause_tracing(self):
+        if not self.pause_tracing:
+            return
+        self.pause_tracing = False
+        if not self.clients:
+            self.tracing = False
 
-    def set_step(self, mode):
-        self.step_mode = mode
-        self.step_level = 0
-        self.stop_module = None
-        self.stop_lineno = None
-        thread.debugger_resumed()
-        self.resume.set()
+    def set_step(self, mode, ident=None):
+        state = self.get_paused_state(ident)
+        if not state:
+            return
+        state.step_mode = mode
+        state.step_level = 0
+        state.stop_module = None
+        state.stop_lineno = None
+        self.resume_thread(state)
 
     def set_break(self, module, lineno):
         self.breaks[module].add(lineno)
+        if self.tracing:
+            # frames that are already running have no local trace yet
+            self.inject_trace()
 
     def set_breakpoints_active(self, active):
         self.breakpoints_active = active
 
     def attach_profiler(self, profiler):
+        # call and return events come from the profiler's own setprofile
+        # hook, only line-level profiling needs the trace function
         self.profilers.add(profiler)
+        self.add_client(profiler)
 
     def detach_profiler(self, profiler):
-        self.profilers.remove(profiler)
+        self.profilers.discard(profiler)
+        self.remove_client(profiler)
+
+    def install_profile_hook(self, hook):
+        self.profile_hook = hook
+        threading.setprofile(hook)
+        if self.trace_signal and (
+                threading.current_thread().ident != self.main_thread):
+            os.kill(os.getpid(), self.trace_signal)
+
+    def remove_profile_hook(self):
+        self.profile_hook = None
+        threading.setprofile(None)
 
     def clear_break(self, module, lineno):
         if module in self.breaks:
@@ -240,11 +426,97 @@ class Debugger(object):
             self.source_frame = sys._getframe(3)
         except ValueError:
             self.source_frame = None
+        self.tracing = True
+        self.traced_threads.add(threading.current_thread().ident)
         sys.settrace(self.trace_dispatch)
 
     def detach(self):
         sys.settrace(None)
+        self.traced_threads.discard(threading.current_thread().ident)
         self.source_frame = None
+        if not self.clients:
+            self.tracing = False
+
+    def add_client(self, client):
+        if not self.clients:
+            self.start_tracing()
+        self.clients.add(client)
+
+    def remove_client(self, client):
+        if not client in self.clients:
+            return
+        self.clients.remove(client)
+        if not self.clients:
+            self.stop_tracing()
+
+    def start_tracing(self):
+        self.tracing = True
+        self.pause_tracing = False
+        threading.settrace(self.trace_thread)
+        self.signal_main_thread(self.inject_trace())
+
+    def trace_thread(self, frame, event, arg):
+        # installed by threading in every thread started while tracing
+        self.traced_threads.add(threading.current_thread().ident)
+        sys.settrace(self.trace_dispatch)
+        return self.trace_dispatch(frame, event, arg)
+
+    def inject_trace(self, thread_ids=None):
+        # a thread only calls f_trace once it has a trace function of its
+        # own, which we can only install in the main thread via a signal;
+        # returns the threads that will pick up the injected trace
+        current = threading.current_thread().ident
+        reachable = set()
+        for ident, frame in sys._current_frames().items():
+            if ident == current:
+                continue
+            if thread_ids and not ident in thread_ids:
+                continue
+            _set_frame_trace(frame, self.trace_dispatch)
+            if ident in self.traced_threads or (
+                    self.trace_signal and ident == self.main_thread):
+                reachable.add(ident)
+        return reachable
+
+    def signal_main_thread(self, reachable):
+        if (self.trace_signal and self.main_thread in reachable and
+                not self.main_thread in self.traced_threads):
+            os.kill(os.getpid(), self.trace_signal)
+
+    def stop_tracing(self):
+        self.tracing = False
+        self.pause_tracing = False
+        threading.settrace(None)
+        for frame in sys._current_frames().values():
+            _set_frame_trace(frame, None)
+        self.pause_all = False
+        self.pause_threads.clear()
+        for ident in list(self.paused):
+            self.set_continue(ident)
+
+    def reset(self):
+        self.tracing = False
+        self.pause_tracing = False
+        self.pause_all = False
+        self.pause_threads = set()
+        self.traced_threads = set()
+        self.active_thread = None
+        self.clients = set()
+        self.threads = {}
+        self.paused = []
+        self.local = threading.local()
+        if self.main_thread is not None:
+            self.main_thread = threading.current_thread().ident
+        threading.settrace(None)
+        sys.settrace(None)
+
+    def handle_trace_signal(self, signum, frame):
+        if self.tracing:
+            _set_frame_trace(frame, self.trace_dispatch)
+            sys.settrace(self.trace_dispatch)
+            self.traced_threads.add(self.main_thread)
+        if self.profile_hook:
+            sys.setprofile(self.profile_hook)
 
     def set_trace(self):
         frame = sys._getframe().f_back
@@ -253,7 +525,15 @@ class Debugger(object):
             frame = frame.f_back
         if not sys.gettrace():
             self.attach()
-        self.set_step('into')
+        state = self.get_thread_state()
+        state.step_mode = 'into'
+        state.step_level = 0
+
+
+def _set_frame_trace(frame, func):
+    while frame:
+        frame.f_trace = func
+        frame = frame.f_back
 
 
 def get_script_source(scriptId):
@@ -268,6 +548,10 @@ def get_script_source(scriptId):
         return '"Built-in module"'
 
 debugger = Debugger(skip=['chromedebug', 'chromedebug.*', 'ws4py.*'])
+# the boot script registers the trace signal before we are imported
+if thread.trace_signal:
+    debugger.trace_signal = thread.trace_signal
+    debugger.main_thread = thread.main_thread
 
 
 def attach():
@@ -279,6 +563,29 @@ def detach():
 atexit.register(detach)
 
 
+def after_fork():
+    global debug_lock
+    # the lock may have been held by a thread that does not exist here
+    debug_lock = threading.Lock()
+    debugger.reset()
+
+
+def add_client(client):
+    debugger.add_client(client)
+
+
+def remove_client(client):
+    debugger.remove_client(client)
+
+
+def start_tracing():
+    debugger.start_tracing()
+
+
+def stop_tracing():
+    debugger.stop_tracing()
+
+
 def trace(func):
     @wraps(func)
     def inner(*args, **kwargs):
@@ -311,9 +618,37 @@ def add_breakpoint(url, lineno):
         'locations': [{'scriptId': url, 'lineNumber': lineno}]}
 
 
-def evaluate_on_frame(frame_id, expression, group=None, preview=False):
+def get_code(expression, mode):
+    key = (expression, mode)
     try:
-        obj = debugger.evaluate_on_frame(frame_id, expression)
+        code = code_cache.pop(key)
+    except KeyError:
+        try:
+            code = compile(expression, '<console>', mode)
+        except SyntaxError:
+            if mode != 'eval':
+                raise
+            # remember that this one has to be executed as a statement
+            code = None
+        if len(code_cache) >= MAX_CODE_CACHE:
+            code_cache.popitem(last=False)
+    code_cache[key] = code
+    return code
+
+
+def evaluate(expression, global_vars, local_vars):
+    code = get_code(expression, 'eval')
+    if code is None:
+        code = get_code(expression, 'exec')
+    return eval(code, global_vars, local_vars)
+
+
+def _encode_result(frame, expression, group, preview):
+    try:
+        if not frame:
+            obj = None
+        else:
+            obj = evaluate(expression, frame.f_globals, frame.f_locals)
         if group:
             inspector.add_obj_to_group(obj, group)
         return {'result': inspector.encode(obj, preview=preview)}
@@ -323,12 +658,31 @@ def evaluate_on_frame(frame_id, expression, group=None, preview=False):
             'wasThrown': True}
 
 
+def evaluate_on_frame(frame_id, expression, group=None, preview=False):
+    frame = debugger.get_paused_frame(frame_id)
+    return _encode_result(frame, expression, group, preview)
+
+
+def evaluate_many_on_frame(frame_id, expressions, group=None, preview=False):
+    frame = debugger.get_paused_frame(frame_id)
+    return [_encode_result(frame, expression, group, preview)
+            for expression in expressions]
+
+
 def get_state():
     return debugger.get_pause_info()
 
 
-def pause():
-    debugger.set_step('into')
+def get_threads():
+    return debugger.get_threads()
+
+
+def set_active_thread(thread_id):
+    return debugger.set_active_thread(thread_id)
+
+
+def pause(thread_ids=None):
+    return debugger.set_pause(thread_ids)
 
 
 def remove_breakpoint(break_id):
@@ -336,12 +690,12 @@ def remove_breakpoint(break_id):
     debugger.clear_break(module, int(lineno) + 1)
 
 
-def resume():
-    debugger.set_continue()
+def resume(thread_id=None):
+    debugger.set_continue(thread_id)
 
 
-def continue_to(url, lineno):
-    debugger.continue_to(url, lineno)
+def continue_to(url, lineno, thread_id=None):
+    debugger.continue_to(url, lineno, thread_id)
 
 
 def set_breakpoints_active(active):
@@ -356,16 +710,24 @@ def detach_profiler(profiler):
     debugger.detach_profiler(profiler)
 
 
-def step_into():
-    debugger.set_step('into')
+def install_profile_hook(hook):
+    debugger.install_profile_hook(hook)
+
+
+def remove_profile_hook():
+    debugger.remove_profile_hook()
+
+
+def step_into(thread_id=None):
+    debugger.set_step('into', thread_id)
 
 
-def step_over():
-    debugger.set_step('over')
+def step_over(thread_id=None):
+    debugger.set_step('over', thread_id)
 
 
-def step_out():
-    debugger.set_step('out')
+def step_out(thread_id=None):
+    debugger.set_step('out', thread_id)
 
 
 def set_trace():
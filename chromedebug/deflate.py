@@ -0,0 +1,119 @@
+import zlib
+
+from ws4py.framing import Frame, OPCODE_BINARY, OPCODE_TEXT
+
+# both sides start every message with a fresh context so a message can be
+# compressed once and sent to any number of clients
+EXTENSION = ('permessage-deflate; server_no_context_takeover; '
+             'client_no_context_takeover')
+ACCEPTED_PARAMS = set([
+    'client_max_window_bits',
+    'client_no_context_takeover',
+    'server_no_context_takeover'])
+THRESHOLD = 1024
+TAIL = b'\x00\x00\xff\xff'
+
+_last_frame = None
+
+
+def negotiate(environ):
+    offers = environ.get('HTTP_SEC_WEBSOCKET_EXTENSIONS')
+    if not offers or THRESHOLD is None:
+        return False
+    for offer in offers.split(','):
+        params = [param.strip() for param in offer.split(';')]
+        if params[0] != 'permessage-deflate':
+            continue
+        names = set(param.split('=', 1)[0].strip() for param in params[1:])
+        if names <= ACCEPTED_PARAMS:
+            # ws4py only accepts extensions it knows verbatim
+            environ['HTTP_SEC_WEBSOCKET_EXTENSIONS'] = EXTENSION
+            return True
+    return False
+
+
+def compress(data):
+    compressor = zlib.compressobj(
+        zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+    data = compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    return data[:-len(TAIL)]
+
+
+def decompress(data):
+    return zlib.decompressobj(-zlib.MAX_WBITS).decompress(data + TAIL)
+
+
+def build_frame(payload, binary=False):
+    global _last_frame
+    # the same event is usually broadcast to every client in a row
+    last = _last_frame
+    if last and last[0] is payload:
+        return last[1]
+    data = payload
+    if isinstance(data, unicode):
+        data = data.encode('utf-8')
+    opcode = OPCODE_BINARY if binary else OPCODE_TEXT
+    frame = Frame(opcode=opcode, body=compress(data), fin=1, rsv1=1).build()
+    _last_frame = (payload, frame)
+    return frame
+
+
+class FrameScanner(object):
+    # ws4py rejects frames with the rsv1 bit set so it is cleared before the
+    # bytes reach the stream parser and compressed text frames are passed
+    # as binary to skip its UTF-8 validation
+
+    def __init__(self):
+        self.header = bytearray()
+        self.remaining = 0
+        self.messages = []
+
+    def get_header_size(self):
+        if len(self.header) < 2:
+            return 2
+        size = 2
+        length = self.header[1] & 0x7f
+        if length == 126:
+            size += 2
+        elif length == 127:
+            size += 8
+        if self.header[1] & 0x80:
+            size += 4
+        return size
+
+    def get_payload_size(self):
+        length = self.header[1] & 0x7f
+        if length == 126:
+            length = self.header[2] << 8 | self.header[3]
+        elif length == 127:
+            length = 0
+            for byte in self.header[2:10]:
+                length = length << 8 | byte
+        return length
+
+    def feed(self, data):
+        data = bytearray(data)
+        pos = 0
+        while pos < len(data):
+            if self.remaining:
+                step = min(self.remaining, len(data) - pos)
+                self.remaining -= step
+                pos += step
+                continue
+            if not self.header:
+                first = data[pos]
+                opcode = first & 0x0f
+                if first & 0x40:
+                    self.messages.append(True)
+                    data[pos] = first & 0xb0 | OPCODE_BINARY
+                elif opcode in (OPCODE_TEXT, OPCODE_BINARY):
+                    self.messages.append(False)
+            self.header.append(data[pos])
+            pos += 1
+            if len(self.header) == self.get_header_size():
+                self.remaining = self.get_payload_size()
+                self.header = bytearray()
+        return bytes(data)
+
+    def pop_message(self):
+        return self.messages.pop(0) if self.messages else False
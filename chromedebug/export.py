@@ -0,0 +1,141 @@
+import json
+import os
+
+from . import profiler
+
+__all__ = ['export_profile', 'FORMATS']
+
+
+def _iter_nodes(node, stack=()):
+    stack = stack + (node,)
+    yield node, stack
+    for child in node['children']:
+        for item in _iter_nodes(child, stack):
+            yield item
+
+
+def _get_frame_name(node):
+    return '%s (%s:%s)' % (
+        node['functionName'], node['url'], node['lineNumber'])
+
+
+def _write_list(f, items):
+    first = True
+    for item in items:
+        if not first:
+            f.write(',')
+        f.write(json.dumps(item))
+        first = False
+
+
+def write_cpuprofile(profile, f, title=None):
+    samples = []
+    weights = []
+
+    def nodes():
+        for node, stack in _iter_nodes(profile['head']):
+            self_time = int(node['selfTime'] * 1000)
+            if self_time > 0:
+                samples.append(node['id'])
+                weights.append(self_time)
+            data = {
+                'id': node['id'],
+                'callFrame': {
+                    'functionName': node['functionName'],
+                    'scriptId': node['url'],
+                    'url': node['url'],
+                    'lineNumber': max(node['lineNumber'] - 1, -1),
+                    'columnNumber': -1},
+                'hitCount': 1 if self_time > 0 else 0,
+                'children': [c['id'] for c in node['children']]}
+            if node.get('positionTicks'):
+                data['positionTicks'] = [
+                    {'line': t['line'], 'ticks': t['ticks']}
+                    for t in node['positionTicks']]
+            yield data
+
+    f.write('{"nodes":[')
+    _write_list(f, nodes())
+    # a delta is the time before its sample, which lasts until the next
+    # one and the last one until the end of the profile
+    deltas = [0] + weights[:-1] if weights else []
+    f.write('],"startTime":0,"endTime":%d,' % (sum(weights),))
+    f.write('"samples":%s,"timeDeltas":%s}' % (
+        json.dumps(samples), json.dumps(deltas)))
+
+
+def write_speedscope(profile, f, title=None):
+    frames = {}
+    total = []
+
+    def samples():
+        for node, stack in _iter_nodes(profile['head']):
+            if node['selfTime'] <= 0 or len(stack) < 2:
+                continue
+            indexes = []
+            for frame in stack[1:]:
+                key = (frame['functionName'], frame['url'],
+                       frame['lineNumber'])
+                if not key in frames:
+                    frames[key] = len(frames)
+                indexes.append(frames[key])
+            total.append(node['selfTime'])
+            yield indexes
+
+    f.write('{"$schema":"https://www.speedscope.app/file-format-schema.json",')
+    f.write('"exporter":"chromedebug","name":%s,' % (json.dumps(title),))
+    f.write('"activeProfileIndex":0,"profiles":[{"type":"sampled",')
+    f.write('"name":%s,"unit":"milliseconds","startValue":0,' % (
+        json.dumps(title),))
+    f.write('"samples":[')
+    _write_list(f, samples())
+    f.write('],"weights":%s,"endValue":%s}],' % (
+        json.dumps(total), json.dumps(sum(total))))
+    shared = [None] * len(frames)
+    for (function, module, lineno), index in frames.iteritems():
+        shared[index] = {'name': function, 'file': module, 'line': lineno}
+    f.write('"shared":{"frames":')
+    f.write(json.dumps(shared))
+    f.write('}}')
+
+
+def write_collapsed(profile, f, title=None):
+    for node, stack in _iter_nodes(profile['head']):
+        weight = int(round(node['selfTime'] * 1000))
+        if weight <= 0 or len(stack) < 2:
+            continue
+        names = [_get_frame_name(n).replace(';', ':') for n in stack[1:]]
+        f.write('%s %d\n' % (';'.join(names), weight))
+
+
+FORMATS = {
+    'collapsed': write_collapsed,
+    'cpuprofile': write_cpuprofile,
+    'speedscope': write_speedscope}
+
+EXTENSIONS = {
+    '.collapsed': 'collapsed',
+    '.cpuprofile': 'cpuprofile',
+    '.folded': 'collapsed',
+    '.speedscope': 'speedscope',
+    '.txt': 'collapsed'}
+
+
+def get_format(path):
+    name = os.path.basename(path)
+    if name.endswith('.speedscope.json'):
+        return 'speedscope'
+    return EXTENSIONS.get(os.path.splitext(name)[1], 'cpuprofile')
+
+
+def export_profile(uid, path, fmt=None):
+    profile = profiler.get_profile(uid)
+    if not profile:
+        raise KeyError('Profile %r not found' % (uid,))
+    fmt = fmt or get_format(path)
+    if not fmt in FORMATS:
+        raise ValueError('Unknown profile format %r' % (fmt,))
+    title = profiler.get_title(uid)
+    with open(path, 'w') as f:
+        FORMATS[fmt](profile, f, title=title)
+    return path
@@ -0,0 +1,255 @@
+import gc
+import json
+import sys
+import tempfile
+import threading
+import types
+
+from . import inspector
+
+__all__ = ['get_heap_object_id', 'get_object_by_heap_id', 'iter_snapshot']
+
+NODE_FIELDS = ['type', 'name', 'id', 'self_size', 'edge_count']
+NODE_TYPES = ['hidden', 'array', 'string', 'object', 'code', 'closure',
+              'regexp', 'number', 'native', 'synthetic',
+              'concatenated string', 'sliced string']
+EDGE_FIELDS = ['type', 'name_or_index', 'to_node']
+EDGE_TYPES = ['context', 'element', 'property', 'internal', 'hidden',
+              'shortcut', 'weak']
+CHUNK_SIZE = 64 * 1024
+MAX_NAME_LENGTH = 100
+
+
+def get_node_type(obj):
+    if isinstance(obj, basestring):
+        return 'string'
+    elif isinstance(obj, (bool, int, long, float)):
+        return 'number'
+    elif isinstance(obj, (list, tuple)):
+        return 'array'
+    elif isinstance(obj, types.CodeType):
+        return 'code'
+    elif isinstance(obj, (types.FunctionType, types.MethodType,
+                          types.BuiltinFunctionType)):
+        return 'closure'
+    return 'object'
+
+
+def get_node_name(obj):
+    if isinstance(obj, basestring):
+        return obj[:MAX_NAME_LENGTH]
+    elif isinstance(obj, (bool, int, long, float)):
+        return repr(obj)
+    elif isinstance(obj, types.ModuleType):
+        return 'module %s' % (obj.__name__,)
+    elif isinstance(obj, (type, types.ClassType)):
+        return 'class %s' % (obj.__name__,)
+    elif isinstance(obj, (types.FunctionType, types.BuiltinFunctionType)):
+        return obj.__name__
+    return type(obj).__name__
+
+
+def iter_edges(obj):
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            if isinstance(key, basestring):
+                yield 'property', key, value
+            else:
+                yield 'property', repr(key)[:MAX_NAME_LENGTH], value
+                yield 'hidden', 0, key
+    elif isinstance(obj, (list, tuple)):
+        for i, value in enumerate(obj):
+            yield 'element', i, value
+    else:
+        obj_dict = getattr(obj, '__dict__', None)
+        for i, ref in enumerate(gc.get_referents(obj)):
+            if ref is obj_dict:
+                yield 'internal', '__dict__', ref
+            elif ref is type(obj):
+                yield 'internal', '__class__', ref
+            else:
+                yield 'hidden', i, ref
+
+
+class HeapSnapshot(object):
+
+    def __init__(self):
+        self.objects = []
+        self.index = {}
+        self.strings = ['']
+        self.string_ids = {'': 0}
+        self.node_count = 0
+        self.edge_count = 0
+
+    def get_string_id(self, value):
+        if isinstance(value, str):
+            value = value.decode('utf-8', 'replace')
+        elif not isinstance(value, unicode):
+            value = unicode(value)
+        if not value in self.string_ids:
+            self.string_ids[value] = len(self.strings)
+            self.strings.append(value)
+        return self.string_ids[value]
+
+    def add(self, obj):
+        if not id(obj) in self.index:
+            self.objects.append(obj)
+            self.index[id(obj)] = len(self.objects)  # node 0 is the root
+
+    def collect(self):
+        own = set([id(self), id(self.__dict__), id(self.objects),
+                   id(self.index), id(self.strings), id(self.string_ids)])
+        objects = gc.get_objects()
+        own.add(id(objects))
+        for obj in objects:
+            if not id(obj) in own:
+                self.add(obj)
+        del objects
+        i = 0
+        while i < len(self.objects):
+            for ref in gc.get_referents(self.objects[i]):
+                if not id(ref) in own:
+                    self.add(ref)
+            i += 1
+        self.node_count = len(self.objects) + 1
+
+    def get_roots(self):
+        yield 'sys.modules', sys.modules
+        names = dict((t.ident, t.name) for t in threading.enumerate())
+        for ident, frame in sys._current_frames().items():
+            yield names.get(ident, str(ident)), frame
+
+    def write_node(self, f, typ, name, node_id, size, edge_count):
+        if self.node_count_written:
+            f.write(',')
+        self.node_count_written += 1
+        f.write('%d,%d,%d,%d,%d' % (
+            NODE_TYPES.index(typ), self.get_string_id(name), node_id, size,
+            edge_count))
+
+    def write_edges(self, f, edges):
+        count = 0
+        for typ, name, target in edges:
+            to_node = self.index.get(id(target))
+            if to_node is None:
+                continue
+            if typ not in ['element', 'hidden']:
+                name = self.get_string_id(name)
+            if self.edge_count:
+                f.write(',')
+            self.edge_count += 1
+            f.write('%d,%d,%d' % (
+                EDGE_TYPES.index(typ), name, to_node * len(NODE_FIELDS)))
+            count += 1
+        return count
+
+    def write(self, nodes, edges, progress=None):
+        self.node_count_written = 0
+        roots = [('shortcut', name, obj) for name, obj in self.get_roots()]
+        count = self.write_edges(edges, roots)
+        self.write_node(nodes, 'synthetic', '(root)', 0, 0, count)
+        for i, obj in enumerate(self.objects):
+            # collected first so a failure cannot leave stray edges behind
+            try:
+                obj_edges = list(iter_edges(obj))
+            except Exception:
+                obj_edges = []
+            count = self.write_edges(edges, obj_edges)
+            try:
+                size = sys.getsizeof(obj)
+            except Exception:
+                size = 0
+            self.write_node(nodes, get_node_type(obj), get_node_name(obj),
+                            id(obj), size, count)
+            if progress and not i % 10000:
+                progress(i, self.node_count)
+
+    def get_header(self):
+        meta = {
+            'node_fields': NODE_FIELDS,
+            'node_types': [NODE_TYPES, 'string', 'number', 'number',
+                           'number'],
+            'edge_fields': EDGE_FIELDS,
+            'edge_types': [EDGE_TYPES, 'string_or_number', 'node'],
+            'trace_function_info_fields': [],
+            'trace_node_fields': [],
+            'sample_fields': [],
+            'location_fields': []}
+        return {
+            'meta': meta,
+            'node_count': self.node_count,
+            'edge_count': self.edge_count,
+            'trace_function_count': 0}
+
+
+def _iter_file(f):
+    f.seek(0)
+    while True:
+        chunk = f.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        yield chunk
+
+
+def _iter_strings(strings):
+    chunk = []
+    size = 0
+    separator = ''
+    for value in strings:
+        value = json.dumps(value)
+        chunk.append(value)
+        size += len(value)
+        if size >= CHUNK_SIZE:
+            yield separator + ','.join(chunk)
+            chunk = []
+            size = 0
+            separator = ','
+    if chunk:
+        yield separator + ','.join(chunk)
+
+
+def iter_snapshot(progress=None):
+    snapshot = HeapSnapshot()
+    snapshot.collect()
+    # nodes and edges are spooled to disk so that each object is only
+    # visited once and the serialized snapshot never sits in memory
+    nodes = tempfile.TemporaryFile()
+    edges = tempfile.TemporaryFile()
+    try:
+        snapshot.write(nodes, edges, progress=progress)
+        snapshot.objects = None
+        snapshot.index = None
+        yield '{"snapshot":%s,"nodes":[' % (
+            json.dumps(snapshot.get_header()),)
+        for chunk in _iter_file(nodes):
+            yield chunk
+        yield '],"edges":['
+        for chunk in _iter_file(edges):
+            yield chunk
+        yield ('],"trace_function_infos":[],"trace_tree":[],"samples":[],'
+               '"locations":[],"strings":[')
+        for chunk in _iter_strings(snapshot.strings):
+            yield chunk
+        yield ']}'
+    finally:
+        nodes.close()
+        edges.close()
+    if progress:
+        progress(snapshot.node_count, snapshot.node_count)
+
+
+def get_heap_object_id(object_id):
+    return str(object_id)
+
+
+def get_object_by_heap_id(heap_id):
+    try:
+        heap_id = int(heap_id)
+    except (TypeError, ValueError):
+        return None
+    if heap_id in inspector.properties:
+        return inspector.get_object(heap_id)
+    for obj in gc.get_objects():
+        if id(obj) == heap_id:
+            inspector.save_properties(obj)
+            return obj
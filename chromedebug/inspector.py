@@ -1,17 +1,185 @@
 from collections import defaultdict, namedtuple
+import math
+import sys
 import types
 import weakref
 
+PAGE_SIZE = 100
+PREVIEW_SIZE = 10
 
 properties = {}
 groups = defaultdict(list)
+type_completions = weakref.WeakKeyDictionary()
 
 
 Property = namedtuple('Property', 'name value bound enumerable descriptor')
+BufferInfo = namedtuple('BufferInfo', 'format shape strides itemsize nbytes')
+
+
+class ElementRange(object):
+    # never registered itself, its id is a path from its buffer
+    __slots__ = ['owner', 'start', 'stop']
+
+    def __init__(self, owner, start, stop):
+        self.owner = owner
+        self.start = start
+        self.stop = stop
+
+    def __unicode__(self):
+        return u'[%d \u2026 %d]' % (self.start, self.stop - 1)
+
+    def __repr__(self):
+        return unicode(self).encode('utf-8')
+
+
+class SubArray(object):
+    # numpy returns a new view on every access so rows are addressed
+    # through their buffer as well
+    __slots__ = ['owner', 'index']
+
+    def __init__(self, owner, index):
+        self.owner = owner
+        self.index = index
+
+    def resolve(self):
+        owner = resolve_buffer(self.owner)
+        return get_items(owner, get_buffer_info(owner))[self.index]
+
+    def __repr__(self):
+        return repr(self.resolve())
+
+
+def resolve_buffer(obj):
+    if isinstance(obj, SubArray):
+        return obj.resolve()
+    return obj
+
+
+def get_numpy():
+    # never imported here, arrays can only exist if the application did
+    return sys.modules.get('numpy')
+
+
+def is_ndarray(obj):
+    numpy = get_numpy()
+    return isinstance(obj, getattr(numpy, 'ndarray', ()))
+
+
+def is_buffer(obj):
+    return (isinstance(obj, (bytearray, memoryview, SubArray)) or
+            is_ndarray(obj))
+
+
+def get_buffer_info(obj):
+    if is_ndarray(obj):
+        return BufferInfo(str(obj.dtype), obj.shape, obj.strides,
+                          obj.itemsize, obj.nbytes)
+    view = obj if isinstance(obj, memoryview) else memoryview(obj)
+    shape = tuple(int(dim) for dim in view.shape or ())
+    itemsize = int(view.itemsize)
+    nbytes = itemsize
+    for dim in shape:
+        nbytes *= dim
+    return BufferInfo(view.format, shape,
+                      tuple(int(step) for step in view.strides or ()),
+                      itemsize, nbytes)
+
+
+def get_array(obj):
+    if is_ndarray(obj):
+        return obj
+    numpy = get_numpy()
+    if numpy is None:
+        return None
+    try:
+        # shares the memory of the buffer
+        return numpy.asarray(memoryview(obj))
+    except Exception:
+        return None
+
+
+def get_items(obj, info):
+    if is_ndarray(obj) or isinstance(obj, bytearray):
+        return obj
+    if len(info.shape) == 1:
+        return obj if isinstance(obj, memoryview) else memoryview(obj)
+    # multi-dimensional memoryviews cannot be indexed
+    return get_array(obj)
+
+
+def to_value(value):
+    if hasattr(value, 'dtype') and not getattr(value, 'shape', None):
+        value = value.item()  # numpy scalar
+    if isinstance(value, float) and (math.isinf(value) or
+                                     math.isnan(value)):
+        # not representable in JSON
+        return unicode(value)
+    return value
+
+
+def get_element(owner, items, index):
+    if isinstance(items, memoryview):
+        return to_value(items[index:index + 1].tolist()[0])
+    value = items[index]
+    if is_ndarray(value) and value.shape and items.dtype.kind != 'O':
+        return SubArray(owner, index)
+    return to_value(value)
+
+
+def get_stats(obj):
+    array = get_array(obj)
+    if array is None or not array.size or array.dtype.kind not in 'biuf':
+        return []
+    return [('min', to_value(array.min())),
+            ('max', to_value(array.max())),
+            ('mean', to_value(array.mean()))]
+
+
+def inspect_range(owner, items, start, stop):
+    count = stop - start
+    if count <= PAGE_SIZE:
+        for i in xrange(start, stop):
+            value = get_element(owner, items, i)
+            yield Property(unicode(i), value, True, True, False)
+        return
+    step = PAGE_SIZE
+    while step * PAGE_SIZE < count:
+        step *= PAGE_SIZE
+    for i in xrange(start, stop, step):
+        element_range = ElementRange(owner, i, min(i + step, stop))
+        yield Property(unicode(element_range), element_range, True, True,
+                       False)
+
+
+def inspect_buffer(obj):
+    view = resolve_buffer(obj)
+    info = get_buffer_info(view)
+    yield Property('shape', info.shape, True, False, False)
+    if is_ndarray(view):
+        yield Property('dtype', info.format, True, False, False)
+    else:
+        yield Property('format', info.format, True, False, False)
+    yield Property('strides', info.strides, True, False, False)
+    yield Property('itemsize', info.itemsize, True, False, False)
+    yield Property('nbytes', info.nbytes, True, False, False)
+    for name, value in get_stats(view):
+        yield Property(name, value, True, False, False)
+    items = get_items(view, info)
+    if items is not None and info.shape:
+        for prop in inspect_range(obj, items, 0, info.shape[0]):
+            yield prop
 
 
 def inspect(obj):
-    if isinstance(obj, (frozenset, list, set, tuple)):
+    if isinstance(obj, ElementRange):
+        view = resolve_buffer(obj.owner)
+        items = get_items(view, get_buffer_info(view))
+        for prop in inspect_range(obj.owner, items, obj.start, obj.stop):
+            yield prop
+    elif is_buffer(obj):
+        for prop in inspect_buffer(obj):
+            yield prop
+    elif isinstance(obj, (frozenset, list, set, tuple)):
         for i, v in enumerate(obj):
             yield Property(unicode(i), v, True, False, False)
     elif isinstance(obj, dict):
@@ -60,14 +228,79 @@ def extract_properties(obj, accessors=False):
         yield data
 
 
+def _get_mro(cls):
+    mro = getattr(cls, '__mro__', None)
+    if mro is not None:
+        return mro
+    # old-style classes
+    mro = [cls]
+    for base in cls.__bases__:
+        mro.extend(_get_mro(base))
+    return mro
+
+
+def get_type_completions(cls):
+    mro = _get_mro(cls)
+    cached = type_completions.get(cls)
+    # same size and no unknown key means the namespace has the same keys
+    if cached and len(cached[0]) == len(mro) and all(
+            len(klass.__dict__) == len(keys) and
+            keys.issuperset(klass.__dict__)
+            for klass, keys in zip(mro, cached[0])):
+        return cached[1]
+    keys = tuple(frozenset(klass.__dict__) for klass in mro)
+    names = frozenset(
+        k for klass_keys in keys for k in klass_keys
+        if isinstance(k, basestring) and not k.startswith('_'))
+    try:
+        type_completions[cls] = (keys, names)
+    except TypeError:  # not weakly referenceable
+        pass
+    return names
+
+
+def get_completions(obj):
+    if isinstance(obj, (frozenset, list, set, tuple)):
+        return [unicode(i) for i in xrange(len(obj))]
+    elif isinstance(obj, dict):
+        return list(obj)
+    names = set(get_type_completions(getattr(obj, '__class__', type(obj))))
+    if isinstance(obj, (type, types.ClassType)):
+        names.update(get_type_completions(obj))
+        return list(names)
+    slots = getattr(obj, '__slots__', ())
+    if isinstance(slots, basestring):
+        slots = [slots]
+    names.update(k for k in slots if not k.startswith('_'))
+    instance_dict = getattr(obj, '__dict__', None)
+    if isinstance(instance_dict, dict):
+        names.update(
+            k for k in instance_dict
+            if isinstance(k, basestring) and not k.startswith('_'))
+    return list(names)
+
+
 def get_object(object_id):
+    path = str(object_id).split(':')
     try:
-        object_id = int(object_id)
+        object_id = int(path[0])
         obj = properties[object_id]
     except Exception:
         return []
     if isinstance(obj, weakref.ref):
         obj = obj()
+    # ranges and rows of a buffer are rebuilt from it
+    for step in path[1:]:
+        if obj is None:
+            break
+        try:
+            if '-' in step:
+                start, stop = step.split('-')
+                obj = ElementRange(obj, int(start), int(stop))
+            else:
+                obj = SubArray(obj, int(step))
+        except ValueError:
+            return []
     return obj
 
 
@@ -94,6 +327,10 @@ def add_obj_to_group(obj, group):
 
 
 def save_properties(obj):
+    if isinstance(obj, ElementRange):
+        return '%s:%d-%d' % (save_properties(obj.owner), obj.start, obj.stop)
+    elif isinstance(obj, SubArray):
+        return '%s:%d' % (save_properties(obj.owner), obj.index)
     object_id = id(obj)
     if object_id in properties:
         return str(object_id)
@@ -122,6 +359,8 @@ def get_type(obj):
 def get_subtype(obj):
     if isinstance(obj, (dict, frozenset, list, set, tuple)):
         return 'array'
+    elif is_buffer(obj):
+        return 'typedarray'
     elif isinstance(obj, types.NoneType):
         return 'null'
 
@@ -160,6 +399,33 @@ def encode_array(obj, preview=False, by_value=False):
     return data
 
 
+def preview_buffer(obj, view, info):
+    preview = {'lossless': False}
+    length = info.shape[0] if info.shape else 0
+    items = get_items(view, info)
+    if items is None:
+        props = []
+    else:
+        props = inspect_range(obj, items, 0, min(length, PREVIEW_SIZE))
+    preview['overflow'] = length > PREVIEW_SIZE
+    preview['properties'] = [encode_property(prop) for prop in props]
+    return preview
+
+
+def encode_buffer(obj, preview=False, by_value=False):
+    view = resolve_buffer(obj)
+    info = get_buffer_info(view)
+    data = {}
+    data['objectId'] = save_properties(obj)
+    data['className'] = type(view).__name__
+    data['description'] = '%s(%s) [%s]' % (
+        type(view).__name__, info.format,
+        ', '.join(str(dim) for dim in info.shape))
+    if preview:
+        data['preview'] = preview_buffer(obj, view, info)
+    return data
+
+
 def encode_function(obj, preview=False, by_value=False):
     data = {}
     data['objectId'] = save_properties(obj)
@@ -202,6 +468,7 @@ ENCODERS = [
     ('number', None, encode_value),
     ('object', 'array', encode_array),
     ('object', 'null', encode_none),
+    ('object', 'typedarray', encode_buffer),
     ('object', None, encode_object),
     ('string', None, encode_value)]
 
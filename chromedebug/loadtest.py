@@ -0,0 +1,348 @@
+from collections import defaultdict
+import json
+import optparse
+import os
+import Queue
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from ws4py.client.threadedclient import WebSocketClient
+
+PORT = 9222
+TIMEOUT = 10.0
+REPORT_INTERVAL = 0.25
+BREAK_MARKER = '# break here'
+
+WORKLOAD = '''import sys
+import time
+
+
+def fib(n):
+    if n < 2:
+        return n
+    return fib(n - 1) + fib(n - 2)
+
+
+def work():
+    values = [fib(12) for i in range(10)]  %(marker)s
+    return sum(values)
+
+
+def main():
+    done = 0
+    last = time.time()
+    while True:
+        work()
+        done += 1
+        now = time.time()
+        if now - last >= %(interval)r:
+            sys.stdout.write('%%f %%d\\n' %% (now, done))
+            sys.stdout.flush()
+            done = 0
+            last = now
+
+
+main()
+''' % {'marker': BREAK_MARKER, 'interval': REPORT_INTERVAL}
+
+
+def get_break_line():
+    for lineno, line in enumerate(WORKLOAD.splitlines()):
+        if line.endswith(BREAK_MARKER):
+            return lineno
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = int(round(fraction * (len(values) - 1)))
+    return values[index]
+
+
+class Stats(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.sizes = defaultdict(list)
+        self.timeouts = defaultdict(int)
+
+    def add_call(self, method, elapsed, size):
+        with self.lock:
+            self.latencies[method].append(elapsed)
+            self.sizes[method].append(size)
+
+    def add_event(self, method, size):
+        with self.lock:
+            self.sizes[method].append(size)
+
+    def add_timeout(self, method):
+        with self.lock:
+            self.timeouts[method] += 1
+
+
+class Target(object):
+
+    def __init__(self, port=PORT):
+        self.port = port
+        self.samples = []
+        self.process = None
+        self.directory = None
+
+    def start(self):
+        cur_path = os.path.dirname(os.path.abspath(__file__))
+        paths = [os.path.join(cur_path, 'boot'), os.path.dirname(cur_path)]
+        env = dict(os.environ)
+        if env.get('PYTHONPATH'):
+            paths.append(env['PYTHONPATH'])
+        env['PYTHONPATH'] = os.pathsep.join(paths)
+        env['CHROMEDEBUG_HOST'] = '127.0.0.1'
+        env['CHROMEDEBUG_PORT'] = str(self.port)
+        env.pop('CHROMEDEBUG_SOCKET_DIR', None)
+        env.pop('CHROMEDEBUG_TRACE_SIGNAL', None)
+        env.pop('CHROMEDEBUG_PROFILE', None)
+        # a real file so that the debugger can find the source
+        self.directory = tempfile.mkdtemp(prefix='chromedebug-')
+        path = os.path.join(self.directory, 'workload.py')
+        with open(path, 'w') as f:
+            f.write(WORKLOAD)
+        self.process = subprocess.Popen(
+            [sys.executable, '-u', path], env=env, stdout=subprocess.PIPE)
+        reader = threading.Thread(target=self.read)
+        reader.daemon = True
+        reader.start()
+
+    def read(self):
+        for line in iter(self.process.stdout.readline, ''):
+            try:
+                timestamp, count = line.split()
+                self.samples.append((float(timestamp), int(count)))
+            except ValueError:
+                pass
+
+    def wait_for_server(self, timeout=TIMEOUT):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            try:
+                socket.create_connection(('127.0.0.1', self.port), 1).close()
+                return True
+            except socket.error:
+                time.sleep(0.1)
+        return False
+
+    def get_throughput(self, start, end):
+        done = sum(count for timestamp, count in self.samples
+                   if start < timestamp <= end)
+        return done / (end - start)
+
+    def stop(self):
+        if self.process and self.process.poll() is None:
+            self.process.terminate()
+            self.process.wait()
+        if self.directory:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class ScriptedClient(WebSocketClient):
+
+    def __init__(self, url, stats):
+        super(ScriptedClient, self).__init__(url)
+        self.stats = stats
+        self.lock = threading.Lock()
+        self.last_id = 0
+        self.pending = {}
+        self.events = Queue.Queue()
+        self.runner = None
+
+    def start(self):
+        self.connect()
+        self.runner = threading.Thread(target=self.run_forever)
+        self.runner.daemon = True
+        self.runner.start()
+
+    def stop(self):
+        self.close()
+        if self.runner:
+            self.runner.join(TIMEOUT)
+
+    def call(self, method, **params):
+        with self.lock:
+            self.last_id += 1
+            msg_id = self.last_id
+        done = threading.Event()
+        call = self.pending[msg_id] = [method, time.time(), done, None]
+        self.send(json.dumps(
+            {'id': msg_id, 'method': method, 'params': params}))
+        if not done.wait(TIMEOUT):
+            self.pending.pop(msg_id, None)
+            self.stats.add_timeout(method)
+            return {}
+        return call[3].get('result') or {}
+
+    def received_message(self, message):
+        msg = json.loads(message.data)
+        size = len(message.data)
+        if 'id' in msg:
+            call = self.pending.pop(msg['id'], None)
+            if not call:
+                return
+            method, start, done, _ = call
+            self.stats.add_call(method, time.time() - start, size)
+            call[3] = msg
+            done.set()
+        else:
+            self.stats.add_event(msg['method'], size)
+            self.events.put(msg)
+
+    def clear_events(self):
+        while not self.events.empty():
+            self.events.get_nowait()
+
+    def wait_for(self, method):
+        deadline = time.time() + TIMEOUT
+        while True:
+            remaining = deadline - time.time()
+            try:
+                if remaining <= 0:
+                    raise Queue.Empty()
+                msg = self.events.get(timeout=remaining)
+            except Queue.Empty:
+                self.stats.add_timeout(method)
+                return {}
+            if msg['method'] == method:
+                return msg['params']
+
+
+def run_cycle(client, turn, profile_time):
+    # the debugger state is shared so clients take turns driving it
+    with turn:
+        client.clear_events()
+        breakpoint = client.call(
+            'Debugger.setBreakpointByUrl', url='__main__',
+            lineNumber=get_break_line())
+        paused = client.wait_for('Debugger.paused')
+        frames = paused.get('callFrames')
+        if frames:
+            scope = frames[0]['scopeChain'][0]['object']
+            client.call('Runtime.getProperties', objectId=scope['objectId'])
+        client.call('Debugger.removeBreakpoint',
+                    breakpointId=breakpoint.get('breakpointId'))
+        client.call('Debugger.stepOver')
+        paused = client.wait_for('Debugger.paused')
+        frames = paused.get('callFrames')
+        if frames:
+            client.call('Debugger.evaluateOnCallFrame',
+                        callFrameId=frames[0]['callFrameId'],
+                        expression='values')
+        client.call('Debugger.resume')
+        client.wait_for('Debugger.resumed')
+        client.call('Profiler.start')
+        time.sleep(profile_time)
+        client.call('Profiler.stop')
+        header = client.wait_for('Profiler.addProfileHeader').get('header')
+    if header:
+        client.call('Profiler.getCPUProfile', uid=header['uid'])
+    client.call('Debugger.getScriptSource', scriptId='__main__')
+
+
+def run_client(client, turn, cycles, profile_time):
+    for i in range(cycles):
+        run_cycle(client, turn, profile_time)
+
+
+def connect_clients(count, stats, port=PORT):
+    clients = []
+    for i in range(count):
+        client = ScriptedClient('ws://127.0.0.1:%d/' % (port,), stats)
+        client.start()
+        clients.append(client)
+    for client in clients:
+        client.call('Debugger.enable')
+        client.call('Profiler.enable')
+    return clients
+
+
+def measure(target, duration):
+    start = time.time()
+    time.sleep(duration)
+    return target.get_throughput(start, time.time())
+
+
+def write_report(out, stats, throughput):
+    out.write('%-34s %6s %9s %9s %9s %9s\n' % (
+        'method', 'calls', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms'))
+    for method in sorted(stats.latencies):
+        values = stats.latencies[method]
+        out.write('%-34s %6d %9.2f %9.2f %9.2f %9.2f\n' % (
+            method, len(values), percentile(values, 0.5) * 1000,
+            percentile(values, 0.9) * 1000, percentile(values, 0.99) * 1000,
+            max(values) * 1000))
+    out.write('\n%-34s %6s %9s %9s %9s\n' % (
+        'message', 'count', 'mean B', 'max B', 'total kB'))
+    for method in sorted(stats.sizes):
+        values = stats.sizes[method]
+        out.write('%-34s %6d %9d %9d %9d\n' % (
+            method, len(values), sum(values) / len(values), max(values),
+            sum(values) / 1024))
+    if stats.timeouts:
+        out.write('\ntimeouts: %s\n' % (
+            ', '.join('%s %d' % item for item in sorted(
+                stats.timeouts.items())),))
+    out.write('\n%-34s %12s\n' % ('target', 'iterations/s'))
+    for phase, value in throughput:
+        out.write('%-34s %12.1f\n' % (phase, value))
+
+
+def main(args=None):
+    parser = optparse.OptionParser(
+        usage='%prog [options]',
+        description='Drive the debugger of a synthetic workload with '
+                    'scripted DevTools clients and report latencies, '
+                    'message sizes and the throughput of the workload.')
+    parser.add_option('--port', type='int', default=PORT)
+    parser.add_option('--clients', type='int', default=1)
+    parser.add_option('--cycles', type='int', default=10)
+    parser.add_option('--duration', type='float', default=3.0,
+                      help='seconds to measure each idle phase')
+    parser.add_option('--profile-time', type='float', default=0.2)
+    options, args = parser.parse_args(args)
+    stats = Stats()
+    target = Target(options.port)
+    target.start()
+    clients = []
+    try:
+        if not target.wait_for_server():
+            sys.exit('The target did not start its debugger')
+        throughput = [('no client', measure(target, options.duration))]
+        clients = connect_clients(options.clients, stats, options.port)
+        throughput.append(
+            ('%d idle clients' % (options.clients,),
+             measure(target, options.duration)))
+        turn = threading.Lock()
+        runners = [
+            threading.Thread(target=run_client, args=(
+                client, turn, options.cycles, options.profile_time))
+            for client in clients]
+        start = time.time()
+        for runner in runners:
+            runner.start()
+        for runner in runners:
+            runner.join()
+        throughput.append(
+            ('%d scripted clients' % (options.clients,),
+             target.get_throughput(start, time.time())))
+        write_report(sys.stdout, stats, throughput)
+    finally:
+        for client in clients:
+            client.stop()
+        target.stop()
+
+
+if __name__ == '__main__':
+    main()
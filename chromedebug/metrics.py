@@ -0,0 +1,115 @@
+from collections import defaultdict
+from functools import wraps
+import time
+
+__all__ = ['disable', 'enable', 'get_report']
+
+counters = defaultdict(int)
+timers = defaultdict(lambda: [0, 0.0])
+enabled = False
+_patched = []
+
+
+def count(name, value=1):
+    counters[name] += value
+
+
+def add_time(name, seconds):
+    timer = timers[name]
+    timer[0] += 1
+    timer[1] += seconds
+
+
+def timed(name, func):
+    @wraps(func)
+    def inner(*args, **kwargs):
+        start = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            add_time(name, time.time() - start)
+
+    return inner
+
+
+def timed_dispatch(func):
+    @wraps(func)
+    def inner(frame, event, arg):
+        counters['trace.%s' % (event,)] += 1
+        start = time.time()
+        try:
+            return func(frame, event, arg)
+        finally:
+            add_time('trace_dispatch', time.time() - start)
+
+    return inner
+
+
+def _patch(obj, name, wrapper):
+    _patched.append((obj, name, obj.__dict__.get(name)))
+    setattr(obj, name, wrapper)
+
+
+def enable():
+    global enabled
+    from . import debugger
+    if enabled:
+        return
+    enabled = True
+    # wrapping keeps the hot paths free of checks while metrics are off
+    instance = debugger.debugger
+    _patch(instance, 'trace_dispatch', timed_dispatch(instance.trace_dispatch))
+    _patch(instance, 'is_skipped', timed('is_skipped', instance.is_skipped))
+    _patch(debugger, 'get_call_info',
+           timed('get_call_info', debugger.get_call_info))
+    if instance.tracing:
+        debugger.start_tracing()
+
+
+def disable():
+    global enabled
+    from . import debugger
+    if not enabled:
+        return
+    enabled = False
+    while _patched:
+        obj, name, original = _patched.pop()
+        if original is None:
+            delattr(obj, name)
+        else:
+            setattr(obj, name, original)
+    if debugger.debugger.tracing:
+        debugger.start_tracing()
+
+
+def reset():
+    counters.clear()
+    timers.clear()
+
+
+def get_clients():
+    from . import thread
+    server = thread.thread.server
+    if not server:
+        return []
+    clients = []
+    for ws in list(server.manager):
+        clients.append({
+            'id': str(id(ws)),
+            'messagesSent': getattr(ws, 'messages_sent', 0),
+            'bytesSent': getattr(ws, 'bytes_sent', 0)})
+    return clients
+
+
+def get_report():
+    from . import inspector
+    return {
+        'enabled': enabled,
+        'counters': dict(counters),
+        'timers': dict(
+            (name, {'count': n, 'totalTime': total * 1000.0})
+            for name, (n, total) in timers.items()),
+        'gauges': {
+            'inspector.properties': len(inspector.properties),
+            'inspector.groups': len(inspector.groups)},
+        'clients': get_clients()}
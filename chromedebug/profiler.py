@@ -1,27 +1,78 @@
+from array import array
+import atexit
+from collections import OrderedDict
+import dis
+import fnmatch
 import inspect
+import json
+import linecache
+import os
+import shutil
+import sys
+import tempfile
+import threading
 import time
+import types
+import zlib
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2 needs the pytracemalloc backport
+    tracemalloc = None
 
 from . import debugger
+from . import timeline
 
+# rough cost of a (parent, key) entry in the child index
+INDEX_ENTRY_SIZE = 64
+# key of code objects whose calls are not recorded
+SKIPPED = -1
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__)) + os.sep
 
 _uid = 0
-profilers = []
+profilers = OrderedDict()
 current_profiler = None
+export_dir = None
+export_format = 'cpuprofile'
+max_profiles = 10
+max_bytes = 64 * 1024 * 1024
+store = None
+allocation_profiles = OrderedDict()
+current_allocation_profiler = None
+# tracemalloc lists the most recent frame first before Python 3.7
+TRACEBACK_OLDEST_FIRST = sys.version_info >= (3, 7)
 
 
 class Profiler(object):
 
-    def __init__(self, title):
+    def __init__(self, title, line_patterns=None):
         global _uid
         _uid += 1
         self.uid = _uid
         self.title = title
-        self.children = {}
-        self.samples = []
+        # node 0 is the root, node n is reported with the id n + 1
+        self.parents = array('l', [0])
+        self.keys = array('l', [0])
+        self.calls = array('l', [0])
+        self.times = array('d', [0.0])
+        self.starts = array('d', [0.0])
+        self.call_infos = [None]
+        self.code_keys = {}
+        self.c_keys = {}
+        self.index = {}
+        # threads only take it to grow the tables
+        self.lock = threading.Lock()
+        self.samples = array('l')
         self.start_time = _get_timestamp()
         self.duration = None
-        self.path = []
-        self._id = 1
+        self.local = threading.local()
+        self.paths = []
+        self.line_patterns = list(line_patterns) if line_patterns else None
+        self.line_codes = {}
+        self.line_modules = {}
+        self.lines = {}
+        self.node_lines = {}
+        self.node_codes = {}
 
     def _is_own_frame(self, frame):
         if not inspect:  # terminating
@@ -34,29 +85,228 @@ class Profiler(object):
             return True
         return False
 
-    def trace_call(self, call_info):
-        if not self.path:
-            if not call_info in self.children:
-                self.children[call_info] = Trace(call_info, profiler=self)
-            tracer = self.children[call_info]
+    def get_path(self):
+        try:
+            return self.local.path
+        except AttributeError:
+            path = self.local.path = []
+            self.local.line_marks = []
+            self.paths.append(path)
+            return path
+
+    def get_key(self, frame):
+        code = frame.f_code
+        key = self.code_keys.get(code)
+        if key is None:
+            if self.is_skipped(frame):
+                key = self.code_keys[code] = SKIPPED
+                return key
+            key = self.add_key(self.code_keys, code,
+                               lambda: debugger.get_call_info(frame))
+        return key
+
+    def is_skipped(self, frame):
+        # the boot directory holds our sitecustomize module
+        if frame.f_code.co_filename.startswith(PACKAGE_DIR):
+            return True
+        module = frame.f_globals.get('__name__') or ''
+        for pattern in debugger.debugger.skip:
+            if fnmatch.fnmatch(module, pattern):
+                return True
+        return False
+
+    def get_c_key(self, func):
+        owner = getattr(func, '__self__', None)
+        module = getattr(func, '__module__', None)
+        if owner is None or isinstance(owner, types.ModuleType):
+            name = func.__name__
+            module = module or getattr(owner, '__name__', '__builtin__')
         else:
-            tracer = self.path[-1].add_child(call_info)
-        self.samples.append(tracer.id)
-        tracer.trace_call()
-        self.path.append(tracer)
+            name = '%s.%s' % (type(owner).__name__, func.__name__)
+            module = module or type(owner).__module__
+        ident = (module, name)
+        key = self.c_keys.get(ident)
+        if key is None:
+            key = self.add_key(self.c_keys, ident,
+                               lambda: debugger.CallInfo(name, module, 0))
+        return key
+
+    def add_key(self, keys, ident, get_call_info):
+        with self.lock:
+            key = keys.get(ident)
+            if key is None:
+                key = keys[ident] = len(self.call_infos)
+                self.call_infos.append(get_call_info())
+        return key
+
+    def add_node(self, parent, key):
+        # called with the lock held
+        node = len(self.parents)
+        self.parents.append(parent)
+        self.keys.append(key)
+        self.calls.append(0)
+        self.times.append(0.0)
+        self.starts.append(0.0)
+        return node
+
+    def profile_dispatch(self, frame, event, arg):
+        local = self.local
+        skipped = getattr(local, 'skipped', 0)
+        if skipped:
+            # inside a call made by our own code
+            if event in ('call', 'c_call'):
+                local.skipped = skipped + 1
+            else:
+                local.skipped = skipped - 1
+            return
+        # the frame of a C event is its caller
+        key = self.get_key(frame)
+        if event == 'call':
+            caller = frame.f_back
+            if key == SKIPPED or caller and self.get_key(caller) == SKIPPED:
+                local.skipped = 1
+                return
+            self.trace_call(key)
+        elif key == SKIPPED:
+            # our own frames that were already running when the hook was set
+            if event == 'c_call':
+                local.skipped = 1
+        elif event == 'return':
+            self.trace_return()
+        elif event == 'c_call':
+            self.trace_call(self.get_c_key(arg))
+        else:  # c_return and c_exception
+            self.trace_return()
+
+    def trace_call(self, key):
+        path = self.get_path()
+        parent = path[-1] if path else 0
+        child = parent << 32 | key
+        node = self.index.get(child)
+        if node is None:
+            with self.lock:
+                node = self.index.get(child)
+                if node is None:
+                    node = self.index[child] = self.add_node(parent, key)
+        self.calls[node] += 1
+        self.starts[node] = _get_timestamp()
+        self.samples.append(node + 1)
+        path.append(node)
+        if self.line_patterns:
+            self.local.line_marks.append(None)
 
     def trace_return(self):
-        if self.path:
-            self.path[-1].trace_return()
-            self.path.pop()
+        path = self.get_path()
+        if not path:
+            return
+        node = path.pop()
+        now = _get_timestamp()
+        duration = now - self.starts[node]
+        self.times[node] += duration
+        if timeline.functions:
+            timeline.record_function(self.call_infos[self.keys[node]],
+                                     self.starts[node], duration)
+        if self.line_patterns:
+            mark = self.local.line_marks.pop()
+            if mark:
+                self.add_line_time(mark, now)
+
+    def is_line_profiled(self, frame):
+        module = frame.f_globals.get('__name__') or ''
+        for pattern in self.line_patterns:
+            if fnmatch.fnmatch(module, pattern):
+                return True
+        return False
 
-    def generate_id(self):
-        self._id += 1
-        return self._id
+    def wants_lines(self, frame):
+        code = frame.f_code
+        profiled = self.line_codes.get(code)
+        if profiled is None:
+            profiled = self.line_codes[code] = self.is_line_profiled(frame)
+            if profiled:
+                self.line_modules[code] = frame.f_globals.get('__name__')
+        return profiled
+
+    def trace_line(self, frame):
+        path = self.get_path()
+        if not path or not self.wants_lines(frame):
+            return
+        now = _get_timestamp()
+        line_marks = self.local.line_marks
+        mark = line_marks[-1]
+        if mark:
+            self.add_line_time(mark, now)
+        node = path[-1]
+        line_marks[-1] = (node, frame.f_code, frame.f_lineno, now)
+        self.node_codes[node] = frame.f_code
+
+    def add_line_time(self, mark, now):
+        node, code, lineno, start = mark
+        index = lineno - code.co_firstlineno
+        # the totals of a code object annotate the source, those of a node
+        # become its position ticks
+        for table, key in ((self.lines, code), (self.node_lines, node)):
+            hits, times = table.get(key) or table.setdefault(
+                key, _new_line_stats(code))
+            if 0 <= index < len(hits):
+                hits[index] += 1
+                times[index] += now - start
+
+    def iter_line_stats(self, code, stats=None):
+        stats = stats or self.lines.get(code)
+        if not stats:
+            return
+        hits, times = stats
+        for index, count in enumerate(hits):
+            if count:
+                yield code.co_firstlineno + index, count, times[index]
+
+    def get_line_annotations(self, module):
+        annotations = {}
+        for code in self.lines:
+            if self.line_modules.get(code) == module:
+                for lineno, count, duration in self.iter_line_stats(code):
+                    annotations[lineno] = (count, duration)
+        return annotations
+
+    def get_children(self):
+        children = [[] for _ in xrange(len(self.parents))]
+        for node in xrange(1, len(self.parents)):
+            children[self.parents[node]].append(node)
+        return children
+
+    def encode_node(self, node, children, active):
+        call_info = self.call_infos[self.keys[node]]
+        function = call_info.function
+        if node in active:
+            function += ' (did not return)'
+        total_time = self.times[node]
+        children_time = sum(self.times[c] for c in children[node])
+        data = {
+            'functionName': function,
+            'url': call_info.module,
+            'lineNumber': call_info.lineno,
+            'totalTime': total_time,
+            'selfTime': total_time - children_time,
+            'numberOfCalls': self.calls[node],
+            'visible': True,
+            'callUID': self.keys[node],
+            'children': [self.encode_node(c, children, active)
+                         for c in children[node]],
+            'id': node + 1}
+        if node in self.node_lines:
+            stats = self.iter_line_stats(self.node_codes[node],
+                                         self.node_lines[node])
+            data['positionTicks'] = [
+                {'line': lineno, 'ticks': count, 'time': duration}
+                for lineno, count, duration in stats]
+        return data
 
     def get_profile(self):
         if not self.duration:
             self.duration = _get_timestamp() - self.start_time
+        children = self.get_children()
+        active = set(node for path in self.paths for node in path)
         return {
             'head': {
                 'functionName': '(root)',
@@ -66,93 +316,401 @@ class Profiler(object):
                 'selfTime': 0,
                 'numberOfCalls': 0,
                 'visible': True,
-                'callUID': id(self),
-                'children': [c.encode() for c in self.children.values()],
+                'callUID': 0,
+                'children': [self.encode_node(c, children, active)
+                             for c in children[0]],
                 'id': 1},
-            'idleTime': self.duration - self.get_children_duration(),
-            'samples': self.samples}
+            'idleTime': self.duration - self.get_children_duration(children),
+            'samples': self.samples.tolist()}
 
     def get_header(self):
         return {'typeId': 'CPU', 'uid': self.uid, 'title': self.title}
 
-    def get_children_duration(self):
-        return sum(c.total_time for c in self.children.values())
+    def get_size(self):
+        arrays = [self.parents, self.keys, self.calls, self.times,
+                  self.starts, self.samples]
+        size = sum(a.itemsize * len(a) for a in arrays)
+        return size + len(self.index) * INDEX_ENTRY_SIZE
 
+    def get_children_duration(self, children=None):
+        children = children or self.get_children()
+        return sum(self.times[c] for c in children[0])
 
-class Trace(object):
-    children = None
-    in_call = False
-    num_calls = 0
 
-    def __init__(self, call_info, profiler):
-        self.call_info = call_info
-        self.profiler = profiler
-        self.children = {}
-        self.total_time = 0
-        self.id = profiler.generate_id()
+class AllocationProfiler(object):
 
-    def encode(self):
-        function = self.call_info.function
-        if self.in_call:
-            function += ' (did not return)'
-        return {
-            'functionName': function,
-            'url': self.call_info.module,
-            'lineNumber': self.call_info.lineno,
-            'totalTime': self.total_time,
-            'selfTime': self.total_time - self.get_children_duration(),
-            'numberOfCalls': self.num_calls,
-            'visible': True,
-            'callUID': id(self),
-            'children': [c.encode() for c in self.children.values()],
-            'id': self.id}
+    snapshot = None
 
-    def get_samples(self):
-        return sum((c.get_samples() for c in self.children.values()), [id(self)])
+    def __init__(self, title, frames=32):
+        global _uid
+        _uid += 1
+        self.uid = _uid
+        self.title = title
+        self.frames = frames
+        self.owns_tracing = False
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+            self.owns_tracing = True
+
+    def stop(self):
+        own_files = os.path.join(os.path.dirname(__file__), '*')
+        self.snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, own_files)])
+        if self.owns_tracing:
+            tracemalloc.stop()
+
+    def get_profile(self, base=None):
+        root = AllocationNode(None)
+        locations = LocationMap()
+        if base:
+            stats = self.snapshot.compare_to(base.snapshot, 'traceback')
+            sizes = ((s.traceback, s.size_diff) for s in stats)
+        else:
+            stats = self.snapshot.statistics('traceback')
+            sizes = ((s.traceback, s.size) for s in stats)
+        for traceback, size in sizes:
+            frames = list(traceback)
+            if not TRACEBACK_OLDEST_FIRST:
+                frames.reverse()
+            node = root
+            node.total_size += size
+            for frame in frames:
+                node = node.add_child(locations.get_location_info(
+                    frame.filename, frame.lineno))
+                node.total_size += size
+            node.self_size += size
+        self._id = 0
+        return {'head': root.encode(self), 'samples': [], 'uid': self.uid}
 
-    def get_children_duration(self):
-        return sum(c.total_time for c in self.children.values())
+    def generate_id(self):
+        self._id += 1
+        return self._id
 
-    def add_child(self, call_info):
-        if not call_info in self.children:
-            self.children[call_info] = Trace(call_info, profiler=self.profiler)
-        return self.children[call_info]
+    def get_header(self):
+        return {'typeId': 'HEAP-ALLOCATION', 'uid': self.uid,
+                'title': self.title}
 
-    def trace_call(self):
-        self.in_call = True
-        self.num_calls += 1
-        self.start_time = _get_timestamp()
 
-    def trace_return(self):
-        self.in_call = False
-        self.total_time += _get_timestamp() - self.start_time
+class AllocationNode(object):
+
+    def __init__(self, call_info):
+        self.call_info = call_info
+        self.children = {}
+        self.self_size = 0
+        self.total_size = 0
 
+    def add_child(self, call_info):
+        if not call_info in self.children:
+            self.children[call_info] = AllocationNode(call_info)
+        return self.children[call_info]
 
-def start_profiling(name=None):
+    def encode(self, profiler):
+        if self.call_info:
+            function, module, lineno = self.call_info
+        else:
+            function, module, lineno = '(root)', '', 0
+        return {
+            'callFrame': {
+                'functionName': function,
+                'scriptId': module,
+                'url': module,
+                'lineNumber': lineno - 1,
+                'columnNumber': -1},
+            'selfSize': self.self_size,
+            'totalSize': self.total_size,
+            'id': profiler.generate_id(),
+            'children': [c.encode(profiler) for c in self.children.values()]}
+
+
+def _new_line_stats(code):
+    size = _get_last_line(code) - code.co_firstlineno + 1
+    return array('l', [0]) * size, array('d', [0.0]) * size
+
+
+def _get_last_line(code):
+    lineno = code.co_firstlineno
+    for increment in bytearray(code.co_lnotab)[1::2]:
+        lineno += increment
+    return lineno
+
+
+def _is_class_body(code):
+    return code.co_name != '<module>' and '__module__' in code.co_names
+
+
+def _find_code(code, lineno, parent=None):
+    # the innermost code object that has instructions on the line
+    for const in code.co_consts:
+        if not isinstance(const, types.CodeType):
+            continue
+        # the line tables of nested code do not cover their own children
+        if const.co_firstlineno <= lineno:
+            found = _find_code(const, lineno, code)
+            if found:
+                return found
+    if lineno in set(line for _, line in dis.findlinestarts(code)):
+        return code, parent
+
+
+def _get_function_name(code, parent):
+    # named like debugger.get_call_info names the running frame
+    name = code.co_name
+    if parent is not None and _is_class_body(parent) and (
+            code.co_varnames[:1] == ('self',) and code.co_argcount or
+            name == '__new__'):
+        name = '%s.%s' % (parent.co_name, name)
+    return name
+
+
+class LocationMap(object):
+
+    def __init__(self):
+        self.modules = {}
+        for name, module in list(sys.modules.items()):
+            module_file = getattr(module, '__file__', None)
+            if module_file:
+                base = os.path.splitext(os.path.abspath(module_file))[0]
+                self.modules.setdefault(base, name)
+        self.codes = {}
+        self.infos = {}
+
+    def get_code(self, filename):
+        if not filename in self.codes:
+            source = ''.join(linecache.getlines(filename))
+            try:
+                self.codes[filename] = compile(source, filename, 'exec')
+            except Exception:
+                self.codes[filename] = None
+        return self.codes[filename]
+
+    def get_location_info(self, filename, lineno):
+        key = (filename, lineno)
+        if key in self.infos:
+            return self.infos[key]
+        base = os.path.splitext(os.path.abspath(filename))[0]
+        module_name = self.modules.get(base, '(unknown)')
+        function, first_line = '<module>', lineno
+        code = self.get_code(filename)
+        found = _find_code(code, lineno) if code else None
+        if found:
+            code, parent = found
+            function = _get_function_name(code, parent)
+            first_line = code.co_firstlineno
+        info = debugger.CallInfo(function, module_name, first_line)
+        self.infos[key] = info
+        return info
+
+
+def start_allocation_profiling(name=None, frames=32):
+    global current_allocation_profiler
+    if not tracemalloc:
+        raise RuntimeError('Allocation profiling requires tracemalloc')
+    name = name or 'Python allocations %d' % (_uid + 1,)
+    current_allocation_profiler = AllocationProfiler(name, frames=frames)
+    current_allocation_profiler.start()
+
+
+def stop_allocation_profiling():
+    global current_allocation_profiler
+    allocation_profiler = current_allocation_profiler
+    if not allocation_profiler:
+        return None
+    current_allocation_profiler = None
+    allocation_profiler.stop()
+    allocation_profiles[allocation_profiler.uid] = allocation_profiler
+    # snapshots keep every trace so they are not worth spilling
+    while len(allocation_profiles) > max_profiles:
+        allocation_profiles.popitem(last=False)
+    return allocation_profiler.get_profile()
+
+
+def get_allocation_profile(uid, base_uid=None):
+    if not uid in allocation_profiles:
+        return None
+    base = allocation_profiles.get(base_uid) if base_uid else None
+    return allocation_profiles[uid].get_profile(base=base)
+
+
+def get_allocation_headers():
+    return [p.get_header() for p in allocation_profiles.values()]
+
+
+def _profile_dispatch(frame, event, arg):
+    profiler = current_profiler
+    if profiler is None:
+        sys.setprofile(None)
+        return
+    try:
+        profiler.profile_dispatch(frame, event, arg)
+    except Exception:
+        # never let the profiler break the code it profiles
+        pass
+
+
+def start_profiling(name=None, lines=None, current_thread=True):
     next_num = _uid + 1
     name = name or 'Python %d' % (next_num,)
     global current_profiler
-    current_profiler = Profiler(name)
-    profilers.append(current_profiler)
-    debugger.attach_profiler(current_profiler)
+    current_profiler = Profiler(name, line_patterns=lines)
+    profilers[current_profiler.uid] = current_profiler
+    debugger.install_profile_hook(_profile_dispatch)
+    if current_thread:
+        sys.setprofile(_profile_dispatch)
+    if lines:
+        # setprofile has no line events, those still need the tracer
+        debugger.attach_profiler(current_profiler)
+        if current_thread:
+            sys.settrace(debugger.debugger.trace_dispatch)
 
 
 def stop_profiling():
     global current_profiler
-    debugger.detach_profiler(current_profiler)
+    debugger.remove_profile_hook()
+    sys.setprofile(None)
+    if current_profiler.line_patterns:
+        debugger.detach_profiler(current_profiler)
     header = current_profiler.get_header()
     current_profiler = None
+    if export_dir:
+        _export(header['uid'])
+    _enforce_retention()
     return header
 
 
+class ProfileStore(object):
+
+    def __init__(self, directory=None):
+        self.owned = directory is None
+        self.directory = directory or tempfile.mkdtemp(prefix='chromedebug-')
+        self.headers = OrderedDict()
+        # forked processes count profiles from the same uid
+        self.pid = os.getpid()
+
+    def get_path(self, uid):
+        return os.path.join(self.directory,
+                            '%d-%d.json.z' % (self.pid, uid))
+
+    def add(self, profiler):
+        data = json.dumps(profiler.get_profile(), separators=(',', ':'))
+        with open(self.get_path(profiler.uid), 'wb') as f:
+            f.write(zlib.compress(data))
+        self.headers[profiler.uid] = profiler.get_header()
+
+    def load(self, uid):
+        if not uid in self.headers:
+            return None
+        with open(self.get_path(uid), 'rb') as f:
+            return json.loads(zlib.decompress(f.read()))
+
+    def close(self):
+        if self.owned:
+            shutil.rmtree(self.directory, ignore_errors=True)
+        else:
+            for uid in self.headers:
+                os.unlink(self.get_path(uid))
+        self.headers.clear()
+
+
+def set_retention(count=None, size=None, directory=None):
+    global max_profiles, max_bytes, store
+    if count is not None:
+        max_profiles = count
+    if size is not None:
+        max_bytes = size
+    if directory and (not store or store.directory != directory):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        if store:
+            store.close()
+        store = ProfileStore(directory)
+    _enforce_retention()
+
+
+def _enforce_retention():
+    global store
+    finished = [p for p in profilers.values() if p is not current_profiler]
+    total = sum(p.get_size() for p in finished)
+    while finished and (len(finished) > max_profiles or total > max_bytes):
+        oldest = finished.pop(0)
+        total -= oldest.get_size()
+        if not store:
+            store = ProfileStore()
+        store.add(oldest)
+        del profilers[oldest.uid]
+
+
+def after_fork():
+    global store
+    # the files belong to the parent, its atexit handler was inherited
+    if store:
+        store = None if store.owned else ProfileStore(store.directory)
+
+
+def _close_store():
+    if store:
+        store.close()
+atexit.register(_close_store)
+
+
+def set_auto_export(directory, fmt='cpuprofile'):
+    global export_dir, export_format
+    export_dir = directory
+    export_format = fmt
+
+
+def _export(uid):
+    from . import export
+    if not os.path.isdir(export_dir):
+        os.makedirs(export_dir)
+    extension = 'speedscope.json' if export_format == 'speedscope' else (
+        export_format)
+    path = os.path.join(export_dir, 'profile-%d-%d.%s' % (
+        os.getpid(), uid, extension))
+    export.export_profile(uid, path, export_format)
+
+
 def get_profile(uid):
-    ps = [p for p in profilers if p.uid == uid]
-    if ps:
-        return ps[0].get_profile()
+    if uid in profilers:
+        return profilers[uid].get_profile()
+    if store:
+        return store.load(uid)
+
+
+def get_title(uid):
+    if uid in profilers:
+        return profilers[uid].title
+    if store and uid in store.headers:
+        return store.headers[uid]['title']
+
+
+def get_line_annotations(module):
+    for profiler in reversed(profilers.values()):
+        if profiler.line_patterns:
+            annotations = profiler.get_line_annotations(module)
+            if annotations:
+                return annotations
+    return {}
+
+
+def annotate_source(module, source):
+    annotations = get_line_annotations(module)
+    if not annotations:
+        return source
+    lines = source.split('\n')
+    for lineno, (count, duration) in annotations.items():
+        if 0 < lineno <= len(lines):
+            lines[lineno - 1] += '  # %d hits, %.3f ms' % (count, duration)
+    return '\n'.join(lines)
 
 
 def get_profile_headers():
-    return [p.get_header() for p in profilers if p != current_profiler]
+    headers = store.headers.values() if store else []
+    headers += [p.get_header() for p in profilers.values()
+                if p != current_profiler]
+    return headers
 
 
 def _get_timestamp():
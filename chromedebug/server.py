@@ -1,11 +1,94 @@
 import json
+import os
+import socket
 import sys
+import time
 
+from ws4py.server.wsgirefserver import WSGIServer, WebSocketWSGIRequestHandler
+from ws4py.server.wsgiutils import WebSocketWSGIApplication
 from ws4py.websocket import WebSocket
 
 from . import debugger
+from . import deflate
+from . import heap
 from . import inspector
+from . import metrics
 from . import profiler
+from . import timeline
+
+
+MAX_CONSOLE_MESSAGES = 1000
+
+script_parsed_cache = {}
+_last_paused = None
+
+
+class DebuggerWSGIServer(WSGIServer):
+
+    def __init__(self, listener):
+        self.listener = listener
+        WSGIServer.__init__(
+            self, listener.getsockname(), WebSocketWSGIRequestHandler)
+
+    def server_bind(self):
+        # the socket was bound before the first client connected
+        self.socket.close()
+        self.socket = self.listener
+        self.server_address = self.socket.getsockname()
+        host, port = self.server_address[:2]
+        self.server_name = socket.getfqdn(host)
+        self.server_port = port
+        self.setup_environ()
+
+    def server_activate(self):
+        pass
+
+
+class UnixWSGIServer(DebuggerWSGIServer):
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        self.socket.close()
+        self.socket = self.listener
+        self.server_address = self.socket.getsockname()
+        self.server_name = 'localhost'
+        self.server_port = 0
+        self.setup_environ()
+
+    def get_request(self):
+        sock, _ = self.socket.accept()
+        return sock, ('unix', 0)
+
+    def server_close(self):
+        DebuggerWSGIServer.server_close(self)
+        try:
+            os.unlink(self.server_address)
+        except OSError:
+            pass
+
+
+def make_server(listener):
+    if listener.family == socket.AF_UNIX:
+        server = UnixWSGIServer(listener)
+    else:
+        server = DebuggerWSGIServer(listener)
+    server.set_app(DebuggerApplication(
+        WebSocketWSGIApplication(extensions=[deflate.EXTENSION],
+                                 handler_cls=DebuggerWebSocket)))
+    return server
+
+
+class DebuggerApplication(object):
+
+    def __init__(self, websocket_app):
+        self.websocket_app = websocket_app
+
+    def __call__(self, environ, start_response):
+        if environ.get('PATH_INFO') == '/metrics':
+            start_response('200 OK', [('Content-Type', 'application/json')])
+            return [json.dumps(metrics.get_report())]
+        deflate.negotiate(environ)
+        return self.websocket_app(environ, start_response)
 
 
 class DebuggerWebSocket(WebSocket):
@@ -13,18 +96,37 @@ class DebuggerWebSocket(WebSocket):
     console_enabled = False
     debugger_enabled = False
     profiling_enabled = False
+    tracing_enabled = False
+    messages_sent = 0
+    bytes_sent = 0
 
     def __init__(self, *args, **kwargs):
         super(DebuggerWebSocket, self).__init__(*args, **kwargs)
         self.console_messages = []
         self.console_cache = []
         self._call_stack = []
+        self.scanner = None
+        if deflate.EXTENSION in (self.extensions or []):
+            self.scanner = deflate.FrameScanner()
 
     def handle_method(self, method, params):
         resp = {}
         if not debugger or not inspector or not profiler:  # terminating
             return
-        if method == 'Console.disable':
+        if method == 'ChromeDebug.disableMetrics':
+            metrics.disable()
+        elif method == 'ChromeDebug.enableMetrics':
+            metrics.enable()
+        elif method == 'ChromeDebug.evaluateOnCallFrame':
+            preview = params.get('generatePreview', False)
+            object_group = params.get('objectGroup', None)
+            results = debugger.evaluate_many_on_frame(
+                params.get('callFrameId'), params.get('expressions', []),
+                group=object_group, preview=preview)
+            resp['result'] = {'results': results}
+        elif method == 'ChromeDebug.getMetrics':
+            resp['result'] = {'metrics': metrics.get_report()}
+        elif method == 'Console.disable':
             self.console_enabled = False
         elif method == 'Console.enable':
             self.console_enabled = True
@@ -35,11 +137,13 @@ class DebuggerWebSocket(WebSocket):
             location = params.get('location', {})
             debugger.continue_to(
                 location.get('scriptId'),
-                location.get('lineNumber'))
+                location.get('lineNumber'),
+                params.get('threadId'))
         elif method == 'Debugger.disable':
             self.debugger_enabled = False
         elif method == 'Debugger.enable':
             self.debugger_enabled = True
+            debugger.add_client(self)
             for name, module in sys.modules.iteritems():
                 if module:
                     self.debugger_script_parsed(name)
@@ -58,35 +162,83 @@ class DebuggerWebSocket(WebSocket):
             object_id = params.get('functionId')
             props = inspector.get_function_details(object_id)
             resp['result'] = {'details': props}
+        elif method == 'Debugger.getThreads':
+            resp['result'] = {'threads': debugger.get_threads()}
         elif method == 'Debugger.getScriptSource':
-            content = debugger.get_script_source(params.get('scriptId'))
+            script_id = params.get('scriptId')
+            content = debugger.get_script_source(script_id)
+            content = profiler.annotate_source(script_id, content)
             resp['result'] = {'scriptSource': content}
         elif method == 'Debugger.pause':
-            debugger.pause()
+            try:
+                unreachable = debugger.pause(params.get('threadIds'))
+            except RuntimeError, e:
+                resp['error'] = {'message': str(e), 'data': {}}
+            else:
+                if unreachable:
+                    resp['result'] = {'unreachableThreadIds': unreachable}
         elif method == 'Debugger.removeBreakpoint':
             debugger.remove_breakpoint(params.get('breakpointId'))
         elif method == 'Debugger.setBreakpointByUrl':
             breakpoint = debugger.add_breakpoint(params.get('url'),
                                                  params.get('lineNumber'))
             resp['result'] = breakpoint
+        elif method == 'Debugger.setActiveThread':
+            found = debugger.set_active_thread(params.get('threadId'))
+            resp['result'] = {'result': found}
         elif method == 'Debugger.setBreakpointsActive':
             debugger.set_active(params.get('active'))
         elif method == 'Debugger.stepInto':
-            debugger.step_into()
+            debugger.step_into(params.get('threadId'))
         elif method == 'Debugger.stepOver':
-            debugger.step_over()
+            debugger.step_over(params.get('threadId'))
         elif method == 'Debugger.stepOut':
-            debugger.step_out()
+            debugger.step_out(params.get('threadId'))
         elif method == 'Debugger.resume':
-            debugger.resume()
+            debugger.resume(params.get('threadId'))
         elif method == 'Debugger.setOverlayMessage':
             msg = params.get('message')
             if msg:
                 sys.stderr.write('<< %s >>\n' % (msg,))
+        elif method == 'HeapProfiler.getHeapObjectId':
+            heap_id = heap.get_heap_object_id(params.get('objectId'))
+            resp['result'] = {'heapSnapshotObjectId': heap_id}
+        elif method == 'HeapProfiler.getObjectByHeapObjectId':
+            obj = heap.get_object_by_heap_id(params.get('objectId'))
+            object_group = params.get('objectGroup', None)
+            if object_group:
+                inspector.add_obj_to_group(obj, object_group)
+            resp['result'] = {'result': inspector.encode(obj)}
+        elif method == 'HeapProfiler.getAllocationProfile':
+            profile = profiler.get_allocation_profile(
+                params.get('uid'), params.get('baseUid'))
+            resp['result'] = {'profile': profile}
+        elif method == 'HeapProfiler.getAllocationProfileHeaders':
+            headers = profiler.get_allocation_headers()
+            resp['result'] = {'headers': headers}
+        elif method == 'HeapProfiler.startSampling':
+            try:
+                profiler.start_allocation_profiling()
+            except RuntimeError, e:
+                resp['error'] = {'message': str(e), 'data': {}}
+        elif method == 'HeapProfiler.stopSampling':
+            profile = profiler.stop_allocation_profiling()
+            resp['result'] = {'profile': profile}
+        elif method == 'HeapProfiler.takeHeapSnapshot':
+            progress = None
+            if params.get('reportProgress'):
+                progress = self.heap_snapshot_progress
+            for chunk in heap.iter_snapshot(progress=progress):
+                self.send_event('HeapProfiler.addHeapSnapshotChunk',
+                                chunk=chunk)
         elif method == 'Page.enable':
             resp['error'] = {}
+        elif method == 'Profiler.enable':
+            pass
         elif method == 'Profiler.start':
-            profiler.start_profiling()
+            # only line profiling attaches to the tracer
+            profiler.start_profiling(lines=params.get('lineModules'),
+                                     current_thread=False)
             self.send_event('Profiler.setRecordingProfile', isProfiling=True)
         elif method == 'Profiler.stop':
             header = profiler.stop_profiling()
@@ -98,14 +250,31 @@ class DebuggerWebSocket(WebSocket):
         elif method == 'Profiler.getCPUProfile':
             profile = profiler.get_profile(params.get('uid'))
             resp['result'] = {'profile': profile}
+        elif method == 'Timeline.start':
+            self.tracing_enabled = True
+            timeline.start()
+        elif method == 'Timeline.stop':
+            timeline.stop()
+            for record in timeline.iter_records():
+                self.timeline_log(record)
+            self.tracing_enabled = False
+        elif method == 'Tracing.start':
+            categories = params.get('categories', '')
+            timeline.start(record_functions='function' in categories)
+        elif method == 'Tracing.end':
+            timeline.stop()
+            events = timeline.iter_trace_events()
+            for batch in timeline.iter_batches(events):
+                self.send_event('Tracing.dataCollected', value=batch)
+            self.send_event('Tracing.tracingComplete')
         elif method == 'Runtime.callFunctionOn':
             # hacks!
             object_id = params.get('objectId')
             body = params.get('functionDeclaration', '')
             if body.startswith('function getCompletions(primitiveType)'):
                 obj = inspector.get_object(object_id)
-                props = inspector.extract_properties(obj)
-                props = dict((p['name'], True) for p in props)
+                names = inspector.get_completions(obj)
+                props = dict((name, True) for name in names)
                 resp['result'] = {
                     'result': inspector.encode(props, by_value=True)}
             elif body.startswith('function remoteFunction(arrayStr)'):
@@ -141,12 +310,29 @@ class DebuggerWebSocket(WebSocket):
                 'data': {}}
         return resp
 
+    def closed(self, code, reason=None):
+        if not debugger:  # terminating
+            return
+        debugger.remove_client(self)
+
     def debugger_paused(self, stack):
         if not debugger:  # terminating
             return
         if not self.debugger_enabled:
             debugger.resume()
-        self.send_event('Debugger.paused', **stack)
+        global _last_paused
+        # every client gets the same pause, serialize it once
+        last = _last_paused
+        if last and last[0] is stack:
+            data = last[1]
+        else:
+            data = self.encode_event('Debugger.paused', stack)
+            _last_paused = (stack, data)
+        self.send(data)
+
+    def heap_snapshot_progress(self, done, total):
+        self.send_event('HeapProfiler.reportHeapSnapshotProgress',
+                        done=done, total=total, finished=done >= total)
 
     def debugger_resumed(self):
         self.send_event('Debugger.resumed')
@@ -154,9 +340,13 @@ class DebuggerWebSocket(WebSocket):
     def debugger_script_parsed(self, name):
         if not self.debugger_enabled:
             return
-        self.send_event('Debugger.scriptParsed', scriptId=name,
-                        url=name, startLine=0, startColumn=0,
-                        endLine=0, endColumn=0)
+        data = script_parsed_cache.get(name)
+        if data is None:
+            data = script_parsed_cache[name] = self.encode_event(
+                'Debugger.scriptParsed', {
+                    'scriptId': name, 'url': name, 'startLine': 0,
+                    'startColumn': 0, 'endLine': 0, 'endColumn': 0})
+        self.send(data)
 
     def console_log(self, level, typ, params, stack_trace):
         # hold a reference
@@ -168,6 +358,10 @@ class DebuggerWebSocket(WebSocket):
             'parameters': params,
             'stackTrace': stack_trace}
         self.console_messages.append(message)
+        metrics.count('console.queued')
+        if len(self.console_messages) > MAX_CONSOLE_MESSAGES:
+            del self.console_messages[0]
+            metrics.count('console.dropped')
         self.console_flush()
 
     def console_flush(self):
@@ -183,12 +377,38 @@ class DebuggerWebSocket(WebSocket):
             return
         self.send_event('Timeline.eventRecorded', record=record)
 
+    def encode_event(self, method, params):
+        if metrics.enabled:
+            start = time.time()
+            data = json.dumps({'method': method, 'params': params})
+            metrics.add_time('send_event.json', time.time() - start)
+            return data
+        return json.dumps({'method': method, 'params': params})
+
     def send_event(self, method, **kwargs):
-        self.send(json.dumps({'method': method, 'params': kwargs}))
+        self.send(self.encode_event(method, kwargs))
+
+    def send(self, payload, binary=False):
+        self.messages_sent += 1
+        if self.scanner and len(payload) >= deflate.THRESHOLD:
+            frame = deflate.build_frame(payload, binary=binary)
+            self.bytes_sent += len(frame)
+            self._write(frame)
+            return
+        self.bytes_sent += len(payload)
+        super(DebuggerWebSocket, self).send(payload, binary=binary)
+
+    def process(self, data):
+        if self.scanner:
+            data = self.scanner.feed(data)
+        return super(DebuggerWebSocket, self).process(data)
 
     def received_message(self, message):
+        data = message.data
+        if self.scanner and self.scanner.pop_message():
+            data = deflate.decompress(data)
         try:
-            msg = json.loads(message.data)
+            msg = json.loads(data)
         except Exception:
             return
         response = self.handle_method(
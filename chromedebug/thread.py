@@ -1,36 +1,240 @@
+import atexit
+import os
+import signal
 import sys
 import threading
-from wsgiref.simple_server import make_server
 
-from ws4py.server.wsgirefserver import WSGIServer, WebSocketWSGIRequestHandler
-from ws4py.server.wsgiutils import WebSocketWSGIApplication
+__all__ = ['start', 'stop', 'toggle']
 
-__all__ = ['start']
+host = ''
+port = 9222
+socket_dir = None
+trace_signal = None
+main_thread = None
+_os_fork = None
 
 
 class ServerThread(threading.Thread):
     daemon = True
     name = 'ChromeDebug'
     server = None
+    listener = None
+    path = None
+    wakeup = None
+    waker = None
+    stopped = False
+
+    def bind(self):
+        # imported here to keep them off the startup path of every process
+        import socket
+        if socket_dir:
+            self.path = get_socket_path(socket_dir, os.getpid())
+            remove_socket(self.path)
+            listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            address = self.path
+            message = 'ChromeDebug listening on %s\n' % (self.path,)
+        else:
+            listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            address = (host, port)
+            message = (
+                'Navigate to chrome://devtools/devtools.html?ws=%s:%d\n' % (
+                    host or '0.0.0.0', port))
+        try:
+            listener.bind(address)
+            listener.listen(5)
+        except socket.error, e:
+            # usually a subprocess of a debugged process that owns the port
+            listener.close()
+            sys.stderr.write('ChromeDebug disabled: %s\n' % (e,))
+            return None
+        sys.stderr.write(message)
+        return listener
 
     def run(self):
+        import select
+        self.listener = listener = self.bind()
+        if listener is None:
+            return
+        wakeup, self.waker = os.pipe()
+        self.wakeup = wakeup
+        # the server and its imports are only set up once a client connects,
+        # stop() wakes us up through the pipe
+        while not self.stopped:
+            if listener in select.select([listener, wakeup], [], [])[0]:
+                break
+        self.wakeup = None
+        os.close(wakeup)
+        if self.stopped:
+            # whoever stopped us cleans up
+            return
         from . import server
-        self.server = make_server(
-            '', 9222, server_class=WSGIServer,
-            handler_class=WebSocketWSGIRequestHandler,
-            app=WebSocketWSGIApplication(handler_cls=server.DebuggerWebSocket))
-        sys.stderr.write(
-            'Navigate to chrome://devtools/devtools.html?ws=0.0.0.0:9222\n')
+        self.server = server.make_server(listener)
+        if self.stopped:
+            self.server.server_close()
+            self.server = None
+            return
         self.server.initialize_websockets_manager()
         self.server.serve_forever()
 
 thread = ServerThread()
 
 
+def get_socket_path(directory, pid):
+    return os.path.join(directory, '%d.sock' % (pid,))
+
+
+def remove_socket(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+def set_socket_dir(directory):
+    global socket_dir
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    socket_dir = directory
+
+
+def set_address(new_host, new_port):
+    global host, port
+    host = new_host
+    port = new_port
+
+
 def start():
+    global thread
+    if is_running():
+        return
+    if thread.ident is not None:  # threads can only be started once
+        # let a stopped thread release its socket first
+        thread.join()
+        thread = ServerThread()
+    install_fork_hook()
     thread.start()
 
 
+def stop():
+    current = thread
+    current.stopped = True
+    server = current.server
+    close_waker(current)
+    if server:
+        from . import debugger
+        current.server = None
+        server.shutdown()
+        for ws in list(server.manager):
+            debugger.remove_client(ws)
+        server.server_close()
+        debugger.stop_tracing()
+    if current.is_alive() and current is not threading.current_thread():
+        current.join()
+    if not server:
+        if current.listener:
+            current.listener.close()
+        if current.path:
+            remove_socket(current.path)
+
+
+def close_waker(server_thread, wake=True):
+    waker = server_thread.waker
+    if waker is None:
+        return
+    server_thread.waker = None
+    try:
+        if wake:
+            os.write(waker, 'x')
+        os.close(waker)
+    except OSError:  # the thread stopped waiting already
+        pass
+
+
+def is_running():
+    return thread.is_alive() and not thread.stopped
+
+
+def toggle():
+    if is_running():
+        stop()
+    else:
+        start()
+
+
+def install_signal(signum):
+    signal.signal(signum, _handle_signal)
+    signal.siginterrupt(signum, False)
+
+
+def _handle_signal(signum, frame):
+    toggle()
+
+
+def install_trace_signal(signum):
+    # the debugger is imported once the signal arrives
+    global trace_signal, main_thread
+    trace_signal = signum
+    main_thread = threading.current_thread().ident
+    signal.signal(signum, _handle_trace_signal)
+    signal.siginterrupt(signum, False)
+
+
+def _handle_trace_signal(signum, frame):
+    from . import debugger
+    debugger.debugger.handle_trace_signal(signum, frame)
+
+
+def install_fork_hook():
+    global _os_fork
+    if _os_fork:
+        return
+    _os_fork = os.fork
+
+    def fork():
+        running = thread.is_alive()
+        # subprocess replaces the child right away
+        execing = sys._getframe(1).f_globals.get('__name__') == 'subprocess'
+        pid = _os_fork()
+        if pid == 0:
+            after_fork(running and not execing)
+        return pid
+
+    os.fork = fork
+
+
+def after_fork(running):
+    global thread
+    if 'chromedebug.debugger' in sys.modules:
+        from . import debugger
+        debugger.after_fork()
+    if 'chromedebug.profiler' in sys.modules:
+        from . import profiler
+        profiler.after_fork()
+    inherited = thread
+    thread = ServerThread()
+    # close our copies without a shutdown, the parent still uses them
+    if inherited.listener:
+        inherited.listener.close()
+    close_waker(inherited, wake=False)
+    if inherited.wakeup is not None:
+        os.close(inherited.wakeup)
+    if inherited.server:
+        for ws in inherited.server.manager.websockets.values():
+            if ws.sock:
+                ws.sock.close()
+    # only one process can own the TCP port, workers need a socket each
+    if running and socket_dir:
+        start()
+
+
+def _cleanup():
+    # the thread has to be gone before the interpreter tears down the
+    # modules it uses
+    stop()
+atexit.register(_cleanup)
+
+
 def console_log(level, typ, params, stack_trace):
     if not thread.server:
         return
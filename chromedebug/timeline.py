@@ -0,0 +1,189 @@
+from array import array
+from contextlib import contextmanager
+import gc
+import itertools
+import os
+import threading
+import time
+import weakref
+
+__all__ = ['span', 'start', 'stop']
+
+KIND_SPAN = 0
+KIND_GC = 1
+KIND_FUNCTION = 2
+CATEGORIES = ['span', 'gc', 'function']
+RECORD_TYPES = ['TimeStamp', 'GCEvent', 'FunctionCall']
+BUFFER_SIZE = 64 * 1024
+BATCH_SIZE = 1000
+
+
+class EventBuffer(object):
+
+    def __init__(self, size=BUFFER_SIZE):
+        self.size = size
+        self.kinds = array('b', [0]) * size
+        self.names = array('l', [0]) * size
+        self.threads = array('L', [0]) * size
+        self.starts = array('d', [0.0]) * size
+        self.durations = array('d', [0.0]) * size
+        self.strings = []
+        self.string_ids = {}
+        self.lock = threading.Lock()
+        self.counter = itertools.count()
+        self.written = 0
+
+    def intern(self, name):
+        string_id = self.string_ids.get(name)
+        if string_id is None:
+            # only taken once per new name
+            with self.lock:
+                string_id = self.string_ids.get(name)
+                if string_id is None:
+                    string_id = len(self.strings)
+                    self.strings.append(name)
+                    self.string_ids[name] = string_id
+        return string_id
+
+    def record(self, kind, name, start, duration, ident):
+        # next() on a count is atomic so threads never share a slot
+        position = next(self.counter)
+        slot = position % self.size
+        self.kinds[slot] = kind
+        self.names[slot] = self.intern(name)
+        self.threads[slot] = ident
+        self.starts[slot] = start
+        self.durations[slot] = duration
+        self.written = max(self.written, position + 1)
+
+    def iter_events(self):
+        end = self.written
+        for position in xrange(max(0, end - self.size), end):
+            slot = position % self.size
+            yield (self.kinds[slot], self.strings[self.names[slot]],
+                   self.starts[slot], self.durations[slot],
+                   self.threads[slot])
+
+
+buffer = None
+recording = False
+functions = False
+_gc_ref = None
+GC_NAMES = ['GC generation %d' % (generation,) for generation in range(3)]
+
+
+class GCSentinel(object):
+    pass
+
+
+def _get_timestamp():
+    if not time:  # terminating
+        return 0
+    return time.time() * 1000.0
+
+
+def _get_ident():
+    return threading.current_thread().ident
+
+
+def _arm_gc_sentinel():
+    # an unreachable cycle is freed by the next collection of the youngest
+    # generation which then calls back, Python 2 has no other hook
+    global _gc_ref
+    sentinel = GCSentinel()
+    sentinel.cycle = sentinel
+    _gc_ref = weakref.ref(sentinel, _gc_callback)
+
+
+def _gc_callback(ref):
+    global _gc_ref
+    if not recording or ref is not _gc_ref:
+        return
+    # a collection resets the counts of the generations it covers
+    count = gc.get_count()
+    if count[1]:
+        generation = 0
+    elif count[2]:
+        generation = 1
+    else:
+        generation = 2
+    # only the end of a collection can be seen
+    buffer.record(KIND_GC, GC_NAMES[generation], _get_timestamp(), 0.0,
+                  _get_ident())
+    _arm_gc_sentinel()
+
+
+def start(record_functions=False, size=BUFFER_SIZE):
+    global buffer, recording, functions
+    buffer = EventBuffer(size)
+    # the collector callback must not need the lock of the buffer
+    for name in GC_NAMES:
+        buffer.intern(name)
+    functions = record_functions
+    recording = True
+    _arm_gc_sentinel()
+
+
+def stop():
+    global recording, functions, _gc_ref
+    recording = False
+    functions = False
+    _gc_ref = None
+
+
+def record_function(call_info, start_time, duration):
+    buffer.record(KIND_FUNCTION, '%s (%s:%d)' % call_info, start_time,
+                  duration, _get_ident())
+
+
+@contextmanager
+def span(name):
+    if not recording:
+        yield
+        return
+    start_time = _get_timestamp()
+    try:
+        yield
+    finally:
+        buffer.record(KIND_SPAN, name, start_time,
+                      _get_timestamp() - start_time, _get_ident())
+
+
+def iter_trace_events():
+    if not buffer:
+        return
+    pid = os.getpid()
+    names = dict((t.ident, t.name) for t in threading.enumerate())
+    seen = set()
+    for kind, name, start_time, duration, ident in buffer.iter_events():
+        if not ident in seen:
+            seen.add(ident)
+            yield {'name': 'thread_name', 'ph': 'M', 'pid': pid,
+                   'tid': ident,
+                   'args': {'name': names.get(ident, str(ident))}}
+        yield {'name': name, 'cat': CATEGORIES[kind], 'ph': 'X',
+               'ts': start_time * 1000.0, 'dur': duration * 1000.0,
+               'pid': pid, 'tid': ident}
+
+
+def iter_batches(events, size=BATCH_SIZE):
+    batch = []
+    for event in events:
+        batch.append(event)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def iter_records():
+    if not buffer:
+        return
+    for kind, name, start_time, duration, ident in buffer.iter_events():
+        yield {'type': RECORD_TYPES[kind],
+               'startTime': start_time,
+               'endTime': start_time + duration,
+               'thread': str(ident),
+               'data': {'name': name},
+               'children': []}